@@ -38,6 +38,7 @@ from harvester.HarvestLogger import HarvestLogger
 from harvester.TimeFormatter import TimeFormatter
 from harvester.Lock import Lock
 from harvester.Exporter import Exporter
+from harvester.HarvestScheduler import HarvestScheduler
 
 
 def get_config_json(repos_json="conf/repos.json"):
@@ -60,6 +61,28 @@ def get_config_ini(config_file="conf/harvester.conf"):
     return config
 
 
+def get_repository(repoconfig, final_config):
+    '''
+    Create the repository object matching a repos.json entry
+    :param repoconfig: One repository entry from repos.json
+    :param final_config: Global harvest config inherited by the repository
+    :return: HarvestRepository subclass instance, or None for an unknown type
+    '''
+    repo_classes = {
+        "oai": OAIRepository,
+        "ckan": CKANRepository,
+        "dataverse": DataverseRepository,
+        "marklogic": MarkLogicRepository,
+        "opendatasoft": OpenDataSoftRepository,
+        "csw": CSWRepository,
+        "socrata": SocrataRepository,
+        "datastream": DataStreamRepository
+    }
+    if repoconfig['type'] not in repo_classes:
+        return None
+    return repo_classes[repoconfig['type']](final_config)
+
+
 if __name__ == "__main__":
 
     instance_lock = Lock()
@@ -86,6 +109,13 @@ if __name__ == "__main__":
     final_config['abort_after_numerrors'] = int(config['harvest'].get('abort_after_numerrors', 5))
     final_config['record_refresh_days'] = int(config['harvest'].get('record_refresh_days', 30))
     final_config['repo_refresh_days'] = int(config['harvest'].get('repo_refresh_days', 1))
+    final_config['harvest_workers'] = int(config['harvest'].get('harvest_workers', 1))
+    final_config['max_workers_per_host'] = int(config['harvest'].get('max_workers_per_host', 1))
+    final_config['update_workers'] = int(config['harvest'].get('update_workers', 1))
+    final_config['write_batch_size'] = int(config['harvest'].get('write_batch_size', 100))
+    final_config['http_timeout'] = int(config['harvest'].get('http_timeout', 60))
+    final_config['http_pool_connections'] = int(config['harvest'].get('http_pool_connections', 10))
+    final_config['http_pool_maxsize'] = int(config['harvest'].get('http_pool_maxsize', 10))
     final_config['temp_filepath'] = config['harvest'].get('temp_filepath', "temp")
     final_config['export_filepath'] = config['export'].get('export_filepath', "data")
     final_config['export_file_limit_mb'] = int(config['export'].get('export_file_limit_mb', 10))
@@ -125,32 +155,9 @@ if __name__ == "__main__":
 
     if run_harvest:
         # Find any new information in the repositories
-        for repoconfig in repo_configs['repos']:
-            if repoconfig['type'] == "oai":
-                repo = OAIRepository(final_config)
-            elif repoconfig['type'] == "ckan":
-                repo = CKANRepository(final_config)
-            elif repoconfig['type'] == "dataverse":
-                repo = DataverseRepository(final_config)
-            elif repoconfig['type'] == "marklogic":
-                repo = MarkLogicRepository(final_config)
-            elif repoconfig['type'] == "opendatasoft":
-                repo = OpenDataSoftRepository(final_config)
-            elif repoconfig['type'] == "csw":
-                repo = CSWRepository(final_config)
-            elif repoconfig['type'] == "socrata":
-                repo = SocrataRepository(final_config)
-            elif repoconfig['type'] == "datastream":
-                repo = DataStreamRepository(final_config)
-            repo.setLogger(main_log)
-            if 'copyerrorstoemail' in repoconfig and not repoconfig['copyerrorstoemail']:
-                main_log.setErrorsToEmail(False)
-            repo.setRepoParams(repoconfig)
-            repo.setDatabase(dbh)
-            repo.crawl()
-            repo.update_stale_records(config['db'])
-            if 'copyerrorstoemail' in repoconfig and not repoconfig['copyerrorstoemail']:
-                main_log.restoreErrorsToEmail()
+        scheduler = HarvestScheduler(config['db'], main_log, lambda repoconfig: get_repository(repoconfig, final_config),
+                                     final_config['harvest_workers'], final_config['max_workers_per_host'])
+        scheduler.run(repo_configs['repos'])
 
     if run_export:
         # Export the database contents out to files
@@ -1,21 +1,25 @@
 from harvester.HarvestRepository import HarvestRepository
-from harvester.rate_limited import rate_limited
 import ckanapi
+import itertools
 import time
 import json
 import re
 import os.path
 import ftfy
+from urllib.parse import quote
 
 
 class CKANRepository(HarvestRepository):
     """ CKAN Repository """
 
+    search_rows = 1000
+    modified_margin = 3600
+
     def setRepoParams(self, repoParams):
         self.metadataprefix = "ckan"
         self.default_language = "en"
         super(CKANRepository, self).setRepoParams(repoParams)
-        self.ckanrepo = ckanapi.RemoteCKAN(self.url)
+        self.ckanrepo = ckanapi.RemoteCKAN(self.url, session=self.http_session)
         self.domain_metadata = []
 
     def _crawl(self):
@@ -32,6 +36,26 @@ class CKANRepository(HarvestRepository):
         }
         self.repository_id = self.db.update_repo(**kwargs)
 
+        if self.bulk_crawl:
+            self._bulk_crawl()
+            return
+
+        records = self._list_packages()
+
+        item_count = 0
+        for ckan_identifier in records:
+            result = self.db.write_header(ckan_identifier, self.repository_id)
+            item_count = item_count + 1
+            if (item_count % self.update_log_after_numitems == 0):
+                tdelta = time.time() - self.tstart + 0.1
+                self.logger.info("Done {} item headers after {} ({:.1f} items/sec)".format(item_count,
+                                                                                           self.formatter.humanize(
+                                                                                               tdelta),
+                                                                                           item_count / tdelta))
+
+        self.logger.info("Found {} items in feed".format(item_count))
+
+    def _list_packages(self):
         records = self.ckanrepo.call_action('package_list', requests_kwargs={'verify': False})
 
         # If response is limited to 1000, get all records with pagination
@@ -47,18 +71,94 @@ class CKANRepository(HarvestRepository):
                     break
                 records = records + response
 
-        item_count = 0
-        for ckan_identifier in records:
-            result = self.db.write_header(ckan_identifier, self.repository_id)
-            item_count = item_count + 1
-            if (item_count % self.update_log_after_numitems == 0):
-                tdelta = time.time() - self.tstart + 0.1
-                self.logger.info("Done {} item headers after {} ({:.1f} items/sec)".format(item_count,
-                                                                                           self.formatter.humanize(
-                                                                                               tdelta),
-                                                                                           item_count / tdelta))
+        return records
 
-        self.logger.info("Found {} items in feed".format(item_count))
+    def _search_packages(self, start, modified_since=None):
+        data_dict = {'rows': self.search_rows, 'start': start, 'sort': 'name asc'}
+        if modified_since is not None:
+            data_dict['fq'] = "metadata_modified:[{} TO *]".format(
+                time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(modified_since)))
+        return self.ckanrepo.call_action('package_search', data_dict, requests_kwargs={'verify': False})
+
+    def _get_modified_since(self):
+        """ Time to search for changed packages from, or None if a full harvest is due """
+        if int(self.full_harvest_days) <= 0:
+            return None
+        modified_since = self.db.get_repo_setting(self.repository_id, "ckan_modified_since")
+        last_full_harvest = float(self.db.get_repo_setting(self.repository_id, "ckan_last_full_harvest", 0))
+        if modified_since is None or last_full_harvest + int(self.full_harvest_days) * 86400 < self.tstart:
+            return None
+        # Allow for clock differences and for packages indexed while the last crawl was running
+        return float(modified_since) - self.modified_margin
+
+    def _reconcile_deletions(self):
+        """ Mark as deleted any records whose package is no longer in package_list """
+        package_names = set(self._list_packages())
+        if not package_names:
+            self.logger.info("package_list is empty, not checking for deleted items")
+            return
+        existing_records = self.db.get_multiple_records("records", "record_id, local_identifier", "repository_id",
+                                                        self.repository_id, "and deleted=0")
+        delete_count = 0
+        for record in existing_records:
+            if record["local_identifier"] not in package_names:
+                self.db.delete_record({"record_id": record["record_id"], "local_identifier": record["local_identifier"]})
+                delete_count = delete_count + 1
+        self.logger.info("Deleted {} items no longer in package_list".format(delete_count))
+
+    def _bulk_crawl(self):
+        """ Write full records from package_search pages, rather than headers to be fetched one by one later """
+        modified_since = self._get_modified_since()
+        first_page = self._search_packages(0, modified_since)
+        # The portal may return fewer rows per page than asked for
+        page_size = len(first_page["results"]) or self.search_rows
+        pages = itertools.chain([first_page], self._fetch_pages(lambda start: self._search_packages(start, modified_since),
+                                                                range(page_size, int(first_page["count"]), page_size)))
+        if modified_since is None:
+            self.logger.info("Found {} items in feed".format(first_page["count"]))
+        else:
+            self.logger.info("Found {} items changed since {}".format(first_page["count"],
+                                                                      time.strftime("%Y-%m-%d %H:%M:%S UTC",
+                                                                                    time.gmtime(modified_since))))
+
+        item_count = 0
+        batch = []
+        for page in pages:
+            for ckan_record in page["results"]:
+                local_identifier = ckan_record["name"]
+                try:
+                    oai_record = self.format_ckan_to_oai(ckan_record, local_identifier)
+                except Exception as e:
+                    self.logger.error("Unable to map record {}, leaving it to be updated later: {}".format(local_identifier, e))
+                    oai_record = None
+                if oai_record:
+                    batch.append(oai_record)
+                elif oai_record is False:
+                    # This record is not a dataset, remove it from the results
+                    record_id = self.db.get_single_record_id("records", local_identifier,
+                                                             "and repository_id=" + str(self.repository_id))
+                    if record_id is not None:
+                        self.db.delete_record({"record_id": record_id, "local_identifier": local_identifier})
+                else:
+                    self.db.write_header(local_identifier, self.repository_id)
+                if len(batch) >= int(self.write_batch_size):
+                    self.db.write_records(batch, self)
+                    batch = []
+                item_count = item_count + 1
+                if (item_count % self.update_log_after_numitems == 0):
+                    tdelta = time.time() - self.tstart + 0.1
+                    self.logger.info("Done {} items after {} ({:.1f} items/sec)".format(item_count,
+                                                                                        self.formatter.humanize(tdelta),
+                                                                                        item_count / tdelta))
+
+        self.db.write_records(batch, self)
+        self.logger.info("Processed {} items in feed".format(item_count))
+
+        self.db.set_repo_setting(self.repository_id, "ckan_modified_since", int(self.tstart))
+        if modified_since is None:
+            self.db.set_repo_setting(self.repository_id, "ckan_last_full_harvest", int(self.tstart))
+            # package_list is as big as the portal, so only check for deleted packages on full harvests
+            self._reconcile_deletions()
 
     def format_ckan_to_oai(self, ckan_record, local_identifier):
         record = {}
@@ -375,15 +475,31 @@ class CKANRepository(HarvestRepository):
 
         return record
 
-    @rate_limited(5)
     def _update_record(self, record):
         # self.logger.debug("Updating CKAN record {}".format(record['local_identifier']) )
 
         try:
-            ckan_record = self.ckanrepo.call_action('package_show', {'id':record['local_identifier']}, requests_kwargs={'verify': False})
+            # package_show is fetched with a plain GET, rather than through ckanapi, so it can be made conditional
+            package_url = "{}/api/action/package_show?id={}".format(self.url.rstrip("/"),
+                                                                    quote(record['local_identifier']))
+            response = self._conditional_get(record, package_url, verify=False)
+            if response is None:
+                # Unchanged since it was last fetched
+                return True
+            if response.status_code == 403:
+                # Not authorized may mean the record is embargoed, but ODC also uses this to indicate the record was deleted
+                self.db.delete_record(record)
+                return True
+            if response.status_code == 404:
+                # Not found means this record was deleted
+                self.db.delete_record(record)
+                return True
+            response.raise_for_status()
+            ckan_record = response.json()["result"]
             oai_record = self.format_ckan_to_oai(ckan_record, record['local_identifier'])
             if oai_record:
                 self.db.write_record(oai_record, self)
+                self._save_validators(record, package_url, response)
             else:
                 if oai_record is False:
                     # This record is not a dataset, remove it from the results
@@ -393,16 +509,6 @@ class CKANRepository(HarvestRepository):
                     self.db.touch_record(record)
             return True
 
-        except ckanapi.errors.NotAuthorized:
-            # Not authorized may mean the record is embargoed, but ODC also uses this to indicate the record was deleted
-            self.db.delete_record(record)
-            return True
-
-        except ckanapi.errors.NotFound:
-            # Not found means this record was deleted
-            self.db.delete_record(record)
-            return True
-
         except Exception as e:
             self.logger.error("Updating record {} failed: {}".format(record['local_identifier'], e))
             if self.dump_on_failure == True:
@@ -412,8 +518,7 @@ class CKANRepository(HarvestRepository):
                     pass
             # Touch the record so we do not keep requesting it on every run
             self.db.touch_record(record)
-            self.error_count = self.error_count + 1
-            if self.error_count < self.abort_after_numerrors:
+            if self._count_error():
                 return True
 
         return False
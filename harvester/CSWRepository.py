@@ -1,5 +1,5 @@
 from harvester.HarvestRepository import HarvestRepository
-from harvester.rate_limited import rate_limited
+from harvester.HostRateLimiter import HostRateLimiter
 from owslib.csw import CatalogueServiceWeb
 import time
 import json
@@ -15,14 +15,22 @@ warnings.simplefilter("ignore", category=FutureWarning)
 class CSWRepository(HarvestRepository):
     """ CSW Repository """
 
+    iso_schema = "http://www.isotc211.org/2005/gmd"
+    search_rows = 100
+
     def setRepoParams(self, repoParams):
         self.metadataprefix = "csw"
         super(CSWRepository, self).setRepoParams(repoParams)
+        # owslib makes its own requests, outside the shared session, so it waits on the host's limiter by hand
+        self.rate_limiter = HostRateLimiter.for_host(HostRateLimiter.get_host(self.url), self.rate_limit,
+                                                     self.rate_limit_burst, self.rate_limit_max)
         try:
-            self.cswrepo = CatalogueServiceWeb(self.url)
+            self.cswrepo = CatalogueServiceWeb(self.url, timeout=self.http_timeout)
         except:
             self.cswrepo = None
         self.domain_metadata = []
+        # The owslib client keeps the last response on self.cswrepo, so records must be updated one at a time
+        self.update_workers = 1
 
     def _crawl(self):
         kwargs = {
@@ -42,8 +50,13 @@ class CSWRepository(HarvestRepository):
             self.logger.error("Could not initiate this repo to crawl it")
             return
 
+        if self.bulk_crawl:
+            self._bulk_crawl()
+            return
+
         item_count = 0
         while True:
+            self.rate_limiter.acquire()
             try:
                 self.cswrepo.getrecords2(startposition=self.cswrepo.results['nextrecord'])
             except:
@@ -63,49 +76,88 @@ class CSWRepository(HarvestRepository):
 
         self.logger.info("Found {} items in feed".format(item_count))
 
-    def format_csw_to_oai(self, csw_record, local_identifier):
+    def _bulk_crawl(self):
+        """ Write full records from ISO getrecords2 pages, rather than headers to be fetched one by one later """
+        item_count = 0
+        batch = []
+        startposition = 0
+        while True:
+            self.rate_limiter.acquire()
+            self.cswrepo.getrecords2(esn="full", outputschema=self.iso_schema, startposition=startposition,
+                                     maxrecords=self.search_rows)
+            if startposition == 0:
+                self.logger.info("Found {} items in feed".format(self.cswrepo.results['matches']))
+
+            for local_identifier, iso_record in self.cswrepo.records.items():
+                try:
+                    oai_record = self.format_iso_to_oai(iso_record, local_identifier)
+                except Exception as e:
+                    self.logger.error("Unable to map record {}, leaving it to be updated later: {}".format(local_identifier, e))
+                    oai_record = None
+                if oai_record:
+                    batch.append(oai_record)
+                else:
+                    self.db.write_header(local_identifier, self.repository_id)
+                if len(batch) >= int(self.write_batch_size):
+                    self.db.write_records(batch, self)
+                    batch = []
+                item_count = item_count + 1
+                if (item_count % self.update_log_after_numitems == 0):
+                    tdelta = time.time() - self.tstart + 0.1
+                    self.logger.info("Done {} items after {} ({:.1f} items/sec)".format(item_count,
+                                                                                        self.formatter.humanize(tdelta),
+                                                                                        item_count / tdelta))
+
+            # nextrecord is 0 once the last page has been returned
+            nextrecord = int(self.cswrepo.results.get('nextrecord') or 0)
+            if not self.cswrepo.records or nextrecord <= startposition or nextrecord > self.cswrepo.results['matches']:
+                break
+            startposition = nextrecord
+
+        self.db.write_records(batch, self)
+        self.logger.info("Processed {} items in feed".format(item_count))
+
+    def format_iso_to_oai(self, iso_record, local_identifier):
+        """ Map an ISO 19139 record, which unlike the Dublin Core one also has a usable datestamp """
+        if not iso_record.identification:
+            return None
+        identification = iso_record.identification[0]
         record = {}
 
-        if csw_record.language == "eng":
-            record["title"] = csw_record.title
-            record["title"] = record["title"].strip()
+        language = (iso_record.language or iso_record.languagecode or "")[:3].lower()
+        tags = [keyword.name for keywords in identification.keywords for keyword in keywords.keywords if keyword.name]
+        if language == "eng":
+            record["title"] = (identification.title or "").strip()
             record["title_fr"] = ""
-            record["tags"] = csw_record.subjects
-        elif csw_record.language == "fre":
-            record["title_fr"] = csw_record.title
-            record["title_fr"] = record["title_fr"].strip()
+            record["tags"] = tags
+        elif language in ["fre", "fra"]:
+            record["title_fr"] = (identification.title or "").strip()
             record["title"] = ""
-            record["tags_fr"] = csw_record.subjects
+            record["tags_fr"] = tags
 
-        record["description"] = csw_record.abstract
+        record["description"] = identification.abstract
         record["identifier"] = local_identifier
         record["creator"] = self.name
         record["series"] = ""
 
-        if csw_record.bbox:
-            if float(csw_record.bbox.minx) > float(csw_record.bbox.maxx):
-                # longitude values (minx and maxx) are switched by oswlib; switch them back
-                record["geobboxes"] = [{"southLat": csw_record.bbox.miny, "westLon": csw_record.bbox.maxx,
-                                        "northLat": csw_record.bbox.maxy, "eastLon": csw_record.bbox.minx}]
-            elif float(csw_record.bbox.miny) > float(csw_record.bbox.maxy):
-                # sometimes x and y values are switched, so the lats are longs and vice versa
-                # we can look for the same discrepancy that happens in the longs, except it's in the y values now
-                record["geobboxes"] = [{"southLat": csw_record.bbox.minx, "westLon": csw_record.bbox.maxy,
-                                       "northLat": csw_record.bbox.maxx, "eastLon": csw_record.bbox.miny}]
-            else:
-                # default if nothing is wrong (this code isn't executed currently)
-                record["geobboxes"] = [{"southLat": csw_record.bbox.miny, "westLon": csw_record.bbox.minx,
-                                        "northLat": csw_record.bbox.maxy, "eastLon": csw_record.bbox.maxx}]
+        if identification.bbox:
+            # Unlike Dublin Core bounding boxes, ISO ones are always west/east longitudes and south/north latitudes
+            record["geobboxes"] = [{"southLat": identification.bbox.miny, "westLon": identification.bbox.minx,
+                                    "northLat": identification.bbox.maxy, "eastLon": identification.bbox.maxx}]
+
+        if iso_record.datestamp:
+            record["pub_date"] = re.sub("[T ][0-9][0-9]:[0-9][0-9]:[0-9][0-9]\.?[0-9]*[Z]?$", "", iso_record.datestamp)
 
         return record
 
-    @rate_limited(5)
     def _update_record(self, record):
         if self.cswrepo is None:
             return
 
         try:
-            self.cswrepo.getrecordbyid(id=[record['local_identifier']])
+            self.rate_limiter.acquire()
+            # The Dublin Core record has no valid dates (at least at Hakai), so ask for the ISO record instead
+            self.cswrepo.getrecordbyid(id=[record['local_identifier']], outputschema=self.iso_schema)
         except:
             self.logger.error("Unable to update record: {}".format(record['local_identifier']))
             self.db.delete_record(record)
@@ -113,12 +165,7 @@ class CSWRepository(HarvestRepository):
 
         if self.cswrepo.records:
             csw_record = self.cswrepo.records[record['local_identifier']]
-            oai_record = self.format_csw_to_oai(csw_record, record['local_identifier'])
-            # We have to request a second schema to get valid dates, no idea if issue is Hakai-specific
-            self.cswrepo.getrecordbyid(id=[record['local_identifier']], outputschema="http://www.isotc211.org/2005/gmd")
-            oai_record["pub_date"] = self.cswrepo.records[record['local_identifier']].datestamp
-            oai_record["pub_date"] = re.sub("[T ][0-9][0-9]:[0-9][0-9]:[0-9][0-9]\.?[0-9]*[Z]?$", "",
-                                            oai_record["pub_date"])
+            oai_record = self.format_iso_to_oai(csw_record, record['local_identifier'])
             if oai_record:
                 try:
                     self.db.write_record(oai_record, self)
@@ -128,6 +175,9 @@ class CSWRepository(HarvestRepository):
                             print(csw_record)
                         except:
                             pass
+            else:
+                # No identification section to map, this record will be updated by a future crawl
+                self.db.touch_record(record)
             return True
 
         else:
@@ -5,6 +5,9 @@ import hashlib
 import json
 import re
 import pdb
+from contextlib import contextmanager
+
+from harvester.LookupCache import LookupCache
 
 
 class DBInterface:
@@ -15,8 +18,14 @@ class DBInterface:
         self.schema = params.get('schema', None)
         self.user = params.get('user', None)
         self.password = params.get('pass', None)
+        # Seconds to wait on a locked SQLite database when several harvest workers write at once
+        self.timeout = float(params.get('timeout', 60))
         self.connection = None
         self.logger = None
+        self.transaction_depth = 0
+        self.lookup_cache = LookupCache(params.get('lookup_cache_size', 50000))
+        # Cache keys added in the open transaction, which must be dropped if it rolls back
+        self.uncommitted_lookups = []
 
         if self.dbtype == "sqlite":
             self.dblayer = __import__('sqlite3')
@@ -33,7 +42,7 @@ class DBInterface:
             raise ValueError('Database type must be sqlite or postgres in config file')
 
         con = self.getConnection()
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
 
             # This table must always exist
@@ -70,7 +79,7 @@ class DBInterface:
     def getConnection(self):
         if self.connection == None:
             if self.dbtype == "sqlite":
-                self.connection = self.dblayer.connect(self.dbname)
+                self.connection = self.dblayer.connect(self.dbname, timeout=self.timeout)
             elif self.dbtype == "postgres":
                 self.connection = self.dblayer.connect("dbname='%s' user='%s' password='%s' host='%s'" % (
                     self.dbname, self.user, self.password, self.host))
@@ -78,6 +87,69 @@ class DBInterface:
 
         return self.connection
 
+    @contextmanager
+    def transaction(self):
+        """ Run the enclosed statements as one transaction; nested calls join the outermost one """
+        con = self.getConnection()
+        if self.transaction_depth > 0:
+            self.transaction_depth += 1
+            try:
+                yield con
+            finally:
+                self.transaction_depth -= 1
+            return
+
+        self.transaction_depth = 1
+        try:
+            if self.dbtype == "postgres":
+                # The connection stays in autocommit mode, so the transaction is opened and closed explicitly
+                cur = con.cursor()
+                cur.execute("BEGIN")
+                try:
+                    yield con
+                    if con.get_transaction_status() == self.dblayer.extensions.TRANSACTION_STATUS_INERROR:
+                        # A statement failed and was handled, but postgres would silently discard the rest on commit
+                        raise self.dblayer.InternalError("Transaction aborted by an earlier error")
+                    cur.execute("COMMIT")
+                except:
+                    cur.execute("ROLLBACK")
+                    raise
+            else:
+                with con:
+                    yield con
+        except:
+            self.lookup_cache.invalidate(self.uncommitted_lookups)
+            raise
+        finally:
+            self.uncommitted_lookups = []
+            self.transaction_depth = 0
+
+    @contextmanager
+    def savepoint(self, name="batch_item"):
+        """ Inside a postgres transaction, undo only the enclosed statements if any of them fail, so the transaction
+        can carry on; yields a list that is set to [False] if they were undone """
+        succeeded = [True]
+        if self.dbtype != "postgres" or self.transaction_depth == 0:
+            yield succeeded
+            return
+        con = self.getConnection()
+        cur = con.cursor()
+        lookups_before = len(self.uncommitted_lookups)
+        cur.execute("SAVEPOINT " + name)
+        try:
+            yield succeeded
+        except Exception as e:
+            self.logger.error("Rolling back to savepoint {}: {}".format(name, e))
+            succeeded[0] = False
+        if succeeded[0] and con.get_transaction_status() == self.dblayer.extensions.TRANSACTION_STATUS_INERROR:
+            succeeded[0] = False
+        if succeeded[0]:
+            cur.execute("RELEASE SAVEPOINT " + name)
+        else:
+            cur.execute("ROLLBACK TO SAVEPOINT " + name)
+            self.lookup_cache.invalidate(self.uncommitted_lookups[lookups_before:])
+            del self.uncommitted_lookups[lookups_before:]
+
     def getCursor(self, con):
         if self.dbtype == "sqlite":
             con.row_factory = self.getRow()
@@ -104,7 +176,7 @@ class DBInterface:
         setting_value = 0
         con = self.getConnection()
         res = None
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
             cur.execute(
                 self._prep("select setting_value from settings where setting_name = ? order by setting_value desc"),
@@ -118,7 +190,7 @@ class DBInterface:
     def set_setting(self, setting_name, new_value):
         curent_value = self.get_setting(setting_name)
         con = self.getConnection()
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
             if curent_value == 0:
                 cur.execute(self._prep("insert into settings(setting_value, setting_name) values (?,?)"),
@@ -127,11 +199,75 @@ class DBInterface:
                 cur.execute(self._prep("update settings set setting_value = ? where setting_name = ?"),
                             (new_value, setting_name))
 
+    def get_repo_setting(self, repo_id, setting_name, default=None):
+        """ Get a per-repository setting, as stored text """
+        records = self.get_multiple_records("repository_settings", "setting_value", "repository_id", repo_id,
+                                            setting_name=setting_name)
+        for record in records:
+            return record["setting_value"]
+        return default
+
+    def set_repo_setting(self, repo_id, setting_name, new_value):
+        con = self.getConnection()
+        with self.transaction():
+            cur = self.getCursor(con)
+            cur.execute(self._prep("update repository_settings set setting_value = ? where repository_id = ? and setting_name = ?"),
+                        (str(new_value), repo_id, setting_name))
+            if cur.rowcount == 0:
+                cur.execute(self._prep("insert into repository_settings(repository_id, setting_name, setting_value) values (?,?,?)"),
+                            (repo_id, setting_name, str(new_value)))
+
+    def delete_repo_setting(self, repo_id, setting_name):
+        return self.delete_row_generic("repository_settings", "setting_name", setting_name,
+                                       "and repository_id=" + str(int(repo_id)))
+
+    def get_http_validators(self, url):
+        """ Get the ETag and Last-Modified values saved from the last response for this URL """
+        records = self.get_multiple_records("http_validators", "etag, last_modified", "url", url)
+        for record in records:
+            return record["etag"], record["last_modified"]
+        return None, None
+
+    def set_http_validators(self, record_id, url, etag, last_modified):
+        con = self.getConnection()
+        with self.transaction():
+            cur = self.getCursor(con)
+            if etag is None and last_modified is None:
+                cur.execute(self._prep("delete from http_validators where url = ?"), (url,))
+                return
+            cur.execute(self._prep("update http_validators set record_id = ?, etag = ?, last_modified = ? where url = ?"),
+                        (record_id, etag, last_modified, url))
+            if cur.rowcount == 0:
+                cur.execute(self._prep("insert into http_validators(record_id, url, etag, last_modified) values (?,?,?,?)"),
+                            (record_id, url, etag, last_modified))
+
+    def get_dataverse_name(self, repo_id, dataverse_id, min_timestamp=0):
+        """ Get a dataverse's name, if it was stored no earlier than min_timestamp """
+        records = self.get_multiple_records("dataverse_names", "dataverse_name", "repository_id", repo_id,
+                                            "and updated_timestamp >= " + str(int(min_timestamp)),
+                                            dataverse_id=str(dataverse_id))
+        for record in records:
+            return record["dataverse_name"]
+        return None
+
+    def set_dataverse_names(self, repo_id, names):
+        """ Store a dict of dataverse IDs to names, replacing any stored before """
+        if not names:
+            return
+        con = self.getConnection()
+        now = int(time.time())
+        with self.transaction():
+            cur = self.getCursor(con)
+            rows = [(repo_id, str(dataverse_id)) for dataverse_id in names]
+            cur.executemany(self._prep("delete from dataverse_names where repository_id = ? and dataverse_id = ?"), rows)
+            cur.executemany(self._prep("insert into dataverse_names(repository_id, dataverse_id, dataverse_name, updated_timestamp) values (?,?,?,?)"),
+                            [(repo_id, str(dataverse_id), name, now) for dataverse_id, name in names.items()])
+
     def update_repo(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
         con = self.getConnection()
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
             if self.repo_id > 0:
                 # Existing repo
@@ -237,14 +373,14 @@ class DBInterface:
         update_vals.append(record_id)
 
         con = self.getConnection()
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
             cur.execute(self._prep(update_record_sql),
                         update_vals)
 
     def update_last_crawl(self, repo_id):
         con = self.getConnection()
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
             cur.execute(self._prep("update repositories set last_crawl_timestamp = ? where repository_id = ?"),
                         (int(time.time()), repo_id))
@@ -253,11 +389,11 @@ class DBInterface:
         con = self.getConnection()
         if record['record_id'] == 0:
             return False
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
 
             try:
-                cur.execute(self._prep("UPDATE records set deleted = 1, modified_timestamp = ?, upstream_modified_timestamp = ? where record_id=?"),
+                cur.execute(self._prep("UPDATE records set deleted = 1, modified_timestamp = ?, upstream_modified_timestamp = ?, content_hash = NULL where record_id=?"),
                             (time.time(), time.time(), record['record_id']))
             except:
                 self.logger.error("Unable to mark as deleted record {}".format(record['local_identifier']))
@@ -274,6 +410,7 @@ class DBInterface:
                 self.delete_all_related_records("descriptions", record['record_id'])
                 self.delete_all_related_records("geospatial", record['record_id'])
                 self.delete_all_related_records("domain_metadata", record['record_id'])
+                self.delete_all_related_records("http_validators", record['record_id'])
             except:
                 self.logger.error(
                     "Unable to delete related table rows for record {}".format(record['local_identifier']))
@@ -284,7 +421,7 @@ class DBInterface:
 
     def purge_deleted_records(self):
         con = self.getConnection()
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
             try:
                 sqlstring = "DELETE from records where deleted=1"
@@ -302,7 +439,7 @@ class DBInterface:
 
     def delete_row_generic(self, tablename, columnname, column_value, extrawhere=""):
         con = self.getConnection()
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
             try:
                 sqlstring = "DELETE from {} where {}=? {}".format(tablename, columnname, extrawhere)
@@ -322,9 +459,18 @@ class DBInterface:
         raise ValueError("tables.json missing valcol definition for {}".format(tablename))
 
     def insert_related_record(self, tablename, val, **kwargs):
+        related_record_id = None
+        try:
+            related_record_id = self._insert_lookup_record(tablename, val, **kwargs)
+        except self.dblayer.IntegrityError as e:
+            self.logger.error("Record insertion problem: {}".format(e))
+
+        return related_record_id
+
+    def _insert_lookup_record(self, tablename, val, **kwargs):
+        """ Insert a lookup table row and return its id, raising IntegrityError if the value is already there """
         valcolumn = self.get_table_value_column(tablename)
         idcolumn = self.get_table_id_column(tablename)
-        related_record_id = None
         paramlist = {valcolumn: val}
         for key, value in kwargs.items():
             paramlist[key] = value
@@ -333,19 +479,13 @@ class DBInterface:
             ",".join(str("?") for k in list(paramlist.keys())))
 
         con = self.getConnection()
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
-            try:
-                if self.dbtype == "postgres":
-                    cur.execute(self._prep(sqlstring + " RETURNING " + idcolumn), list(paramlist.values()))
-                    related_record_id = int(cur.fetchone()[idcolumn])
-                if self.dbtype == "sqlite":
-                    cur.execute(self._prep(sqlstring), list(paramlist.values()))
-                    related_record_id = int(cur.lastrowid)
-            except self.dblayer.IntegrityError as e:
-                self.logger.error("Record insertion problem: {}".format(e))
-
-        return related_record_id
+            if self.dbtype == "postgres":
+                cur.execute(self._prep(sqlstring + " RETURNING " + idcolumn), list(paramlist.values()))
+                return int(cur.fetchone()[idcolumn])
+            cur.execute(self._prep(sqlstring), list(paramlist.values()))
+            return int(cur.lastrowid)
 
     def insert_cross_record(self, crosstable, relatedtable, related_id, record_id, **kwargs):
         cross_table_id = None
@@ -359,7 +499,7 @@ class DBInterface:
             ",".join(str("?") for k in list(paramlist.keys())))
 
         con = self.getConnection()
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
             try:
                 if self.dbtype == "postgres":
@@ -372,6 +512,43 @@ class DBInterface:
                 self.logger.error("Record insertion problem: {}".format(e))
 
 
+    def insert_cross_records(self, crosstable, relatedtable, related_ids, record_id, **kwargs):
+        """ Link several related rows to a record with a single executemany """
+        if not related_ids:
+            return
+        relatedidcolumn = self.get_table_id_column(relatedtable)
+        columns = ["record_id", relatedidcolumn] + list(kwargs.keys())
+        sqlstring = "INSERT INTO {} ({}) VALUES ({})".format(
+            crosstable, ",".join(columns), ",".join("?" for k in columns))
+        rows = [[record_id, related_id] + list(kwargs.values()) for related_id in related_ids]
+
+        con = self.getConnection()
+        with self.transaction():
+            cur = self.getCursor(con)
+            try:
+                cur.executemany(self._prep(sqlstring), rows)
+            except self.dblayer.IntegrityError as e:
+                self.logger.error("Record insertion problem: {}".format(e))
+
+    def delete_related_records(self, crosstable, column_values, record_id, extrawhere=""):
+        """ Unlink several related rows from a record with a single executemany """
+        if not column_values:
+            return True
+        columnname = self.get_table_value_column(crosstable)
+        return self.delete_rows_generic(crosstable, columnname, column_values,
+                                        "and record_id=" + str(record_id) + " " + extrawhere)
+
+    def delete_rows_generic(self, tablename, columnname, column_values, extrawhere=""):
+        con = self.getConnection()
+        with self.transaction():
+            cur = self.getCursor(con)
+            try:
+                sqlstring = "DELETE from {} where {}=? {}".format(tablename, columnname, extrawhere)
+                cur.executemany(self._prep(sqlstring), [(column_value,) for column_value in column_values])
+            except:
+                return False
+        return True
+
     def get_multiple_records(self, tablename, columnlist, given_col, given_val, extrawhere="", **kwargs):
         records = []
         paramlist = {}
@@ -381,7 +558,7 @@ class DBInterface:
             extrawhere = extrawhere + " and " + "=? and ".join(str(k) for k in list(paramlist.keys())) + "=?"
         sqlstring = "select {} from {} where {}=? {}".format(columnlist, tablename, given_col, extrawhere)
         con = self.getConnection()
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
             cur.execute(self._prep(sqlstring), [given_val] + (list(paramlist.values())))
             if cur is not None:
@@ -399,6 +576,52 @@ class DBInterface:
 
         return returnvalue
 
+    def get_related_record_id(self, tablename, val, language=None, **kwargs):
+        """ Find or insert a lookup table row (creators, tags, rights...), returning (id, inserted) """
+        lookup = {}
+        if language is not None:
+            lookup["language"] = language
+        key = (tablename, language, val)
+        related_record_id = self.lookup_cache.get(key)
+        if related_record_id is not None:
+            return related_record_id, False
+
+        inserted = False
+        related_record_id = self.get_single_record_id(tablename, val, **lookup)
+        if related_record_id is None:
+            with self.transaction(), self.savepoint("lookup_insert"):
+                try:
+                    related_record_id = self._insert_lookup_record(tablename, val, **dict(lookup, **kwargs))
+                    inserted = True
+                except self.dblayer.IntegrityError:
+                    pass
+            if related_record_id is None:
+                # Another harvest worker inserted the same value first; the unique index kept ours out
+                related_record_id = self.get_single_record_id(tablename, val, **lookup)
+        if related_record_id is None:
+            self.lookup_cache.invalidate([key])
+        else:
+            self.lookup_cache.set(key, related_record_id)
+            if inserted and self.transaction_depth > 0:
+                self.uncommitted_lookups.append(key)
+        return related_record_id, inserted
+
+    def get_related_ids_excluding_language(self, crosstable, relatedtable, record_id, language):
+        """ IDs of a record's related rows (subjects, tags) in any language but the one given, in one query """
+        idcolumn = self.get_table_id_column(relatedtable)
+        sqlstring = ("select x.{0} from {1} x join {2} r on x.{0} = r.{0} "
+                     "where x.record_id=? and (r.language is null or r.language != ?)").format(
+            idcolumn, crosstable, relatedtable)
+        records = []
+        con = self.getConnection()
+        with self.transaction():
+            cur = self.getCursor(con)
+            cur.execute(self._prep(sqlstring), (record_id, language))
+            if cur is not None:
+                records = cur.fetchall()
+
+        return [int(e[idcolumn]) for e in records]
+
     def construct_local_url(self, record):
         oai_id = None
         oai_search = None
@@ -458,27 +681,47 @@ class DBInterface:
         self.logger.error("construct_local_url() failed for item: {}".format(json.dumps(record)) )
         return None
 
-    def create_new_record(self, rec, source_url, repo_id):
+    def _canonical_value(self, value):
+        if isinstance(value, dict):
+            return {k: self._canonical_value(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            # Order and single-value wrapping make no difference to what write_record() stores
+            values = sorted((self._canonical_value(v) for v in value), key=lambda v: json.dumps(v, sort_keys=True, default=str))
+            if len(values) == 1:
+                return values[0]
+            return values
+        return value
+
+    def get_content_hash(self, record, domain_metadata):
+        """ Hash of everything write_record() would store for a record, to spot records unchanged upstream """
+        content = {k: self._canonical_value(v) for k, v in record.items()
+                   if k not in ["record_id", "item_url_pattern", "domain_metadata"]}
+        content["domain_metadata"] = self._canonical_value(domain_metadata)
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps(content, sort_keys=True, default=str).encode('utf-8'))
+        return sha1.hexdigest()
+
+    def create_new_record(self, rec, source_url, repo_id, content_hash=None):
         returnvalue = None
         con = self.getConnection()
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
             try:
                 if self.dbtype == "postgres":
                     cur.execute(self._prep(
                         """INSERT INTO records (title, title_fr, pub_date, series, modified_timestamp, source_url, 
-                        deleted, local_identifier, item_url, repository_id, upstream_modified_timestamp)
-                        VALUES(?,?,?,?,?,?,?,?,?,?,?) RETURNING record_id"""),
+                        deleted, local_identifier, item_url, repository_id, upstream_modified_timestamp, content_hash)
+                        VALUES(?,?,?,?,?,?,?,?,?,?,?,?) RETURNING record_id"""),
                         (rec["title"], rec["title_fr"], rec["pub_date"],  rec["series"], time.time(), source_url, 0,
-                         rec["identifier"], rec["item_url"], repo_id, time.time()))
+                         rec["identifier"], rec["item_url"], repo_id, time.time(), content_hash))
                     returnvalue = int(cur.fetchone()['record_id'])
                 if self.dbtype == "sqlite":
                     cur.execute(self._prep(
                         """INSERT INTO records (title, title_fr, pub_date, series, modified_timestamp, source_url, 
-                        deleted, local_identifier, item_url, repository_id, upstream_modified_timestamp)
-                        VALUES(?,?,?,?,?,?,?,?,?,?,?)"""),
+                        deleted, local_identifier, item_url, repository_id, upstream_modified_timestamp, content_hash)
+                        VALUES(?,?,?,?,?,?,?,?,?,?,?,?)"""),
                         (rec["title"], rec["title_fr"], rec["pub_date"], rec["series"], time.time(), source_url, 0,
-                         rec["identifier"], rec["item_url"], repo_id, time.time()))
+                         rec["identifier"], rec["item_url"], repo_id, time.time(), content_hash))
                     returnvalue = int(cur.lastrowid)
             except self.dblayer.IntegrityError as e:
                 self.logger.error("Record insertion problem: {}".format(e))
@@ -488,19 +731,32 @@ class DBInterface:
     def write_record(self, record, repo):
         repo_id = repo.repository_id
         metadata_prefix = repo.metadataprefix.lower()
-        domain_metadata = repo.domain_metadata
         modified_upstream = False # Track whether metadata changed since last crawl
 
         if record == None:
             return None
-        record["record_id"] = self.get_single_record_id("records", record["identifier"],
-                                                        "and repository_id=" + str(repo_id))
+        # Records may carry their own domain metadata, as a repo can be writing several at once
+        domain_metadata = record.get("domain_metadata", repo.domain_metadata)
+        existing_record = None
+        for existing_record in self.get_multiple_records("records", "*", "local_identifier", record["identifier"],
+                                                         "and repository_id=" + str(repo_id)):
+            pass
+        record["record_id"] = None
+        if existing_record is not None:
+            record["record_id"] = int(existing_record["record_id"])
         record["item_url_pattern"] = repo.item_url_pattern
         if record.get("item_url", None) is None:
             record["item_url"] = self.construct_local_url(record)
 
+        content_hash = self.get_content_hash(record, domain_metadata)
+        if existing_record is not None and existing_record["content_hash"] == content_hash and \
+                not existing_record["deleted"]:
+            # Nothing has changed since this record was last written
+            self.touch_record(record)
+            return None
+
         con = self.getConnection()
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
             source_url = ""
             if 'dc:source' in record:
@@ -510,32 +766,29 @@ class DBInterface:
                     source_url = record["dc:source"]
             if record["record_id"] is None:
                 modified_upstream = True # New record has new metadata
-                record["record_id"] = self.create_new_record(record, source_url, repo_id)
+                record["record_id"] = self.create_new_record(record, source_url, repo_id, content_hash)
             else:
                 # Compare title, title_fr, pub_date, series, source_url, item_url, local_identifier for changes
-                records = self.get_multiple_records("records", "*", "record_id", record["record_id"])
-                if len(records) == 1:
-                    existing_record = records[0]
-                    if existing_record["title"] != record["title"]:
-                        modified_upstream = True
-                    elif existing_record["title_fr"] != record["title_fr"]:
-                        modified_upstream = True
-                    elif existing_record["pub_date"] != record["pub_date"]:
-                        modified_upstream = True
-                    elif existing_record["series"] != record["series"]:
-                        modified_upstream = True
-                    elif existing_record["source_url"] is None and existing_record["source_url"] != source_url:
-                        modified_upstream = True
-                    elif existing_record["item_url"] != record["item_url"]:
-                        modified_upstream = True
-                    elif existing_record["local_identifier"] != record["identifier"]:
-                        modified_upstream = True
+                if existing_record["title"] != record["title"]:
+                    modified_upstream = True
+                elif existing_record["title_fr"] != record["title_fr"]:
+                    modified_upstream = True
+                elif existing_record["pub_date"] != record["pub_date"]:
+                    modified_upstream = True
+                elif existing_record["series"] != record["series"]:
+                    modified_upstream = True
+                elif existing_record["source_url"] is None and existing_record["source_url"] != source_url:
+                    modified_upstream = True
+                elif existing_record["item_url"] != record["item_url"]:
+                    modified_upstream = True
+                elif existing_record["local_identifier"] != record["identifier"]:
+                    modified_upstream = True
                 cur.execute(self._prep(
                     """UPDATE records set title=?, title_fr=?, pub_date=?, series=?, modified_timestamp=?, source_url=?, 
-                    deleted=?, local_identifier=?, item_url=?
+                    deleted=?, local_identifier=?, item_url=?, content_hash=?
                     WHERE record_id = ?"""),
                     (record["title"], record["title_fr"], record["pub_date"], record["series"], time.time(),
-                     source_url, 0, record["identifier"], record["item_url"], record["record_id"]))
+                     source_url, 0, record["identifier"], record["item_url"], content_hash, record["record_id"]))
 
             if record["record_id"] is None:
                 return None
@@ -549,21 +802,18 @@ class DBInterface:
                 existing_creator_ids = [e["creator_id"] for e in existing_creator_recs]
                 new_creator_ids = []
                 for creator in record["creator"]:
-                    creator_id = self.get_single_record_id("creators", creator)
-                    if creator_id is None:
-                        creator_id = self.insert_related_record("creators", creator)
+                    creator_id, inserted = self.get_related_record_id("creators", creator)
+                    if inserted:
                         modified_upstream = True
                     if creator_id is not None:
                         new_creator_ids.append(creator_id)
-                        if creator_id not in existing_creator_ids:
-                            extras = {"is_contributor": 0}
-                            self.insert_cross_record("records_x_creators", "creators", creator_id, record["record_id"],
-                                                     **extras)
-                            modified_upstream = True
-                for eid in existing_creator_ids:
-                    if eid not in new_creator_ids:
-                        modified_upstream = True
-                        self.delete_one_related_record("records_x_creators", eid, record["record_id"], extrawhere)
+                added_ids = [cid for cid in new_creator_ids if cid not in existing_creator_ids]
+                removed_ids = [eid for eid in existing_creator_ids if eid not in new_creator_ids]
+                if added_ids or removed_ids:
+                    modified_upstream = True
+                extras = {"is_contributor": 0}
+                self.insert_cross_records("records_x_creators", "creators", added_ids, record["record_id"], **extras)
+                self.delete_related_records("records_x_creators", removed_ids, record["record_id"], extrawhere)
 
             if "contributor" in record:
                 if not isinstance(record["contributor"], list):
@@ -574,21 +824,18 @@ class DBInterface:
                 existing_creator_ids = [e["creator_id"] for e in existing_creator_recs]
                 new_creator_ids = []
                 for creator in record["contributor"]:
-                    creator_id = self.get_single_record_id("creators", creator)
-                    if creator_id is None:
-                        creator_id = self.insert_related_record("creators", creator)
+                    creator_id, inserted = self.get_related_record_id("creators", creator)
+                    if inserted:
                         modified_upstream = True
                     if creator_id is not None:
                         new_creator_ids.append(creator_id)
-                        if creator_id not in existing_creator_ids:
-                            extras = {"is_contributor": 1}
-                            self.insert_cross_record("records_x_creators", "creators", creator_id, record["record_id"],
-                                                     **extras)
-                            modified_upstream = True
-                for eid in existing_creator_ids:
-                    if eid not in new_creator_ids:
-                        modified_upstream = True
-                        self.delete_one_related_record("records_x_creators", eid, record["record_id"], extrawhere)
+                added_ids = [cid for cid in new_creator_ids if cid not in existing_creator_ids]
+                removed_ids = [eid for eid in existing_creator_ids if eid not in new_creator_ids]
+                if added_ids or removed_ids:
+                    modified_upstream = True
+                extras = {"is_contributor": 1}
+                self.insert_cross_records("records_x_creators", "creators", added_ids, record["record_id"], **extras)
+                self.delete_related_records("records_x_creators", removed_ids, record["record_id"], extrawhere)
             else:
                 extrawhere = "and is_contributor=1"
                 existing_creator_recs = self.get_multiple_records("records_x_creators", "creator_id", "record_id",
@@ -599,58 +846,40 @@ class DBInterface:
             if "subject" in record:
                 if not isinstance(record["subject"], list):
                     record["subject"] = [record["subject"]]
-                existing_subject_recs = self.get_multiple_records("records_x_subjects", "subject_id", "record_id",
-                                                                  record["record_id"])
-                existing_subject_ids_all = [e["subject_id"] for e in existing_subject_recs]
-                existing_subject_ids = existing_subject_ids_all.copy()
-                for eid in existing_subject_ids_all: # remove existing subject ids for fr tags
-                    subject = self.get_multiple_records("subjects", "language", "subject_id", eid)
-                    if subject[0]["language"] == 'fr':
-                        existing_subject_ids.remove(eid)
+                # Existing ids, excluding fr subjects which are handled separately
+                existing_subject_ids = self.get_related_ids_excluding_language("records_x_subjects", "subjects", record["record_id"], "fr")
                 new_subject_ids = []
                 for subject in record["subject"]:
-                    subject_id = self.get_single_record_id("subjects", subject, "and language='en'")
-                    if subject_id is None:
-                        extras = {"language": "en"}
-                        subject_id = self.insert_related_record("subjects", subject, **extras)
+                    subject_id, inserted = self.get_related_record_id("subjects", subject, "en")
+                    if inserted:
                         modified_upstream = True
                     if subject_id is not None:
                         new_subject_ids.append(subject_id)
-                        if subject_id not in existing_subject_ids:
-                            self.insert_cross_record("records_x_subjects", "subjects", subject_id, record["record_id"])
-                            modified_upstream = True
-                for eid in existing_subject_ids:
-                    if eid not in new_subject_ids:
-                        modified_upstream = True
-                        self.delete_one_related_record("records_x_subjects", eid, record["record_id"])
+                added_ids = [rid for rid in new_subject_ids if rid not in existing_subject_ids]
+                removed_ids = [eid for eid in existing_subject_ids if eid not in new_subject_ids]
+                if added_ids or removed_ids:
+                    modified_upstream = True
+                self.insert_cross_records("records_x_subjects", "subjects", added_ids, record["record_id"])
+                self.delete_related_records("records_x_subjects", removed_ids, record["record_id"])
 
             if "subject_fr" in record:
                 if not isinstance(record["subject_fr"], list):
                     record["subject_fr"] = [record["subject_fr"]]
-                existing_subject_recs = self.get_multiple_records("records_x_subjects", "subject_id", "record_id",
-                                                                  record["record_id"])
-                existing_subject_ids_all = [e["subject_id"] for e in existing_subject_recs]
-                existing_subject_ids = existing_subject_ids_all.copy()
-                for eid in existing_subject_ids_all: # remove existing subject ids for en tags
-                    subject = self.get_multiple_records("subjects", "language", "subject_id", eid)
-                    if subject[0]["language"] == 'en':
-                        existing_subject_ids.remove(eid)
+                # Existing ids, excluding en subjects which are handled separately
+                existing_subject_ids = self.get_related_ids_excluding_language("records_x_subjects", "subjects", record["record_id"], "en")
                 new_subject_ids = []
                 for subject in record["subject_fr"]:
-                    subject_id = self.get_single_record_id("subjects", subject, "and language='fr'")
-                    if subject_id is None:
-                        extras = {"language": "fr"}
-                        subject_id = self.insert_related_record("subjects", subject, **extras)
+                    subject_id, inserted = self.get_related_record_id("subjects", subject, "fr")
+                    if inserted:
                         modified_upstream = True
                     if subject_id is not None:
                         new_subject_ids.append(subject_id)
-                        if subject_id not in existing_subject_ids:
-                            self.insert_cross_record("records_x_subjects", "subjects", subject_id, record["record_id"])
-                            modified_upstream = True
-                for eid in existing_subject_ids:
-                    if eid not in new_subject_ids:
-                        modified_upstream = True
-                        self.delete_one_related_record("records_x_subjects", eid, record["record_id"])
+                added_ids = [rid for rid in new_subject_ids if rid not in existing_subject_ids]
+                removed_ids = [eid for eid in existing_subject_ids if eid not in new_subject_ids]
+                if added_ids or removed_ids:
+                    modified_upstream = True
+                self.insert_cross_records("records_x_subjects", "subjects", added_ids, record["record_id"])
+                self.delete_related_records("records_x_subjects", removed_ids, record["record_id"])
 
             if "publisher" in record:
                 if not isinstance(record["publisher"], list):
@@ -660,20 +889,17 @@ class DBInterface:
                 existing_publisher_ids = [e["publisher_id"] for e in existing_publisher_recs]
                 new_publisher_ids = []
                 for publisher in record["publisher"]:
-                    publisher_id = self.get_single_record_id("publishers", publisher)
-                    if publisher_id is None:
-                        publisher_id = self.insert_related_record("publishers", publisher)
+                    publisher_id, inserted = self.get_related_record_id("publishers", publisher)
+                    if inserted:
                         modified_upstream = True
                     if publisher_id is not None:
                         new_publisher_ids.append(publisher_id)
-                        if publisher_id not in existing_publisher_ids:
-                            self.insert_cross_record("records_x_publishers", "publishers", publisher_id,
-                                                     record["record_id"])
-                            modified_upstream = True
-                for eid in existing_publisher_ids:
-                    if eid not in new_publisher_ids:
-                        modified_upstream = True
-                        self.delete_one_related_record("records_x_publishers", eid, record["record_id"])
+                added_ids = [rid for rid in new_publisher_ids if rid not in existing_publisher_ids]
+                removed_ids = [eid for eid in existing_publisher_ids if eid not in new_publisher_ids]
+                if added_ids or removed_ids:
+                    modified_upstream = True
+                self.insert_cross_records("records_x_publishers", "publishers", added_ids, record["record_id"])
+                self.delete_related_records("records_x_publishers", removed_ids, record["record_id"])
 
             if "affiliation" in record:
                 if not isinstance(record["affiliation"], list):
@@ -683,21 +909,17 @@ class DBInterface:
                 existing_affiliation_ids = [e["affiliation_id"] for e in existing_affiliation_recs]
                 new_affiliation_ids = []
                 for affil in record["affiliation"]:
-                    affiliation_id = self.get_single_record_id("affiliations", affil)
-                    if affiliation_id is None:
-                        affiliation_id = self.insert_related_record("affiliations", affil)
-                        modified_upstream = True
-                    if affiliation_id is not None:
-                        if affiliation_id not in existing_affiliation_ids and affiliation_id not in new_affiliation_ids:
-                            self.insert_cross_record("records_x_affiliations", "affiliations", affiliation_id,
-                                                     record["record_id"])
-                            modified_upstream = True
-                        if affiliation_id not in new_affiliation_ids:
-                            new_affiliation_ids.append(affiliation_id)
-                for eid in existing_affiliation_ids:
-                    if eid not in new_affiliation_ids:
+                    affiliation_id, inserted = self.get_related_record_id("affiliations", affil)
+                    if inserted:
                         modified_upstream = True
-                        self.delete_one_related_record("records_x_affiliations", eid, record["record_id"])
+                    if affiliation_id is not None and affiliation_id not in new_affiliation_ids:
+                        new_affiliation_ids.append(affiliation_id)
+                added_ids = [rid for rid in new_affiliation_ids if rid not in existing_affiliation_ids]
+                removed_ids = [eid for eid in existing_affiliation_ids if eid not in new_affiliation_ids]
+                if added_ids or removed_ids:
+                    modified_upstream = True
+                self.insert_cross_records("records_x_affiliations", "affiliations", added_ids, record["record_id"])
+                self.delete_related_records("records_x_affiliations", removed_ids, record["record_id"])
 
             if "rights" in record:
                 if not isinstance(record["rights"], list):
@@ -711,20 +933,18 @@ class DBInterface:
                     sha1 = hashlib.sha1()
                     sha1.update(rights.encode('utf-8'))
                     rights_hash = sha1.hexdigest()
-                    rights_id = self.get_single_record_id("rights", rights_hash)
-                    if rights_id is None:
-                        extras = {"rights": rights}
-                        rights_id = self.insert_related_record("rights", rights_hash, **extras)
+                    extras = {"rights": rights}
+                    rights_id, inserted = self.get_related_record_id("rights", rights_hash, **extras)
+                    if inserted:
                         modified_upstream = True
                     if rights_id is not None:
                         new_rights_ids.append(rights_id)
-                        if rights_id not in existing_rights_ids:
-                            self.insert_cross_record("records_x_rights", "rights", rights_id, record["record_id"])
-                            modified_upstream = True
-                for eid in existing_rights_ids:
-                    if eid not in new_rights_ids:
-                        modified_upstream = True
-                        self.delete_one_related_record("records_x_rights", eid, record["record_id"])
+                added_ids = [rid for rid in new_rights_ids if rid not in existing_rights_ids]
+                removed_ids = [eid for eid in existing_rights_ids if eid not in new_rights_ids]
+                if added_ids or removed_ids:
+                    modified_upstream = True
+                self.insert_cross_records("records_x_rights", "rights", added_ids, record["record_id"])
+                self.delete_related_records("records_x_rights", removed_ids, record["record_id"])
 
             if "description" in record:
                 if not isinstance(record["description"], list):
@@ -747,10 +967,10 @@ class DBInterface:
                             modified_upstream = True
                         if description_id is not None:
                             new_description_ids.append(description_id)
-                for eid in existing_description_ids:
-                    if eid not in new_description_ids:
-                        self.delete_row_generic("descriptions", "description_id", eid)
-                        modified_upstream = True
+                removed_ids = [eid for eid in existing_description_ids if eid not in new_description_ids]
+                if removed_ids:
+                    modified_upstream = True
+                    self.delete_rows_generic("descriptions", "description_id", removed_ids)
 
             if "description_fr" in record:
                 if not isinstance(record["description_fr"], list):
@@ -773,66 +993,48 @@ class DBInterface:
                             modified_upstream = True
                         if description_id is not None:
                             new_description_ids.append(description_id)
-                for eid in existing_description_ids:
-                    if eid not in new_description_ids:
-                        self.delete_row_generic("descriptions", "description_id", eid)
-                        modified_upstream = True
+                removed_ids = [eid for eid in existing_description_ids if eid not in new_description_ids]
+                if removed_ids:
+                    modified_upstream = True
+                    self.delete_rows_generic("descriptions", "description_id", removed_ids)
 
             if "tags" in record:
                 if not isinstance(record["tags"], list):
                     record["tags"] = [record["tags"]]
-                existing_tag_recs = self.get_multiple_records("records_x_tags", "tag_id", "record_id",
-                                                              record["record_id"])
-                existing_tag_ids_all = [e["tag_id"] for e in existing_tag_recs]
-                existing_tag_ids = existing_tag_ids_all.copy()
-                for eid in existing_tag_ids_all: # remove existing tag ids for fr tags
-                    tag = self.get_multiple_records("tags", "language", "tag_id", eid)
-                    if tag[0]["language"] == 'fr':
-                        existing_tag_ids.remove(eid)
+                # Existing ids, excluding fr tags which are handled separately
+                existing_tag_ids = self.get_related_ids_excluding_language("records_x_tags", "tags", record["record_id"], "fr")
                 new_tag_ids = []
                 for tag in record["tags"]:
-                    tag_id = self.get_single_record_id("tags", tag, "and language='en'")
-                    if tag_id is None:
-                        extras = {"language": "en"}
-                        tag_id = self.insert_related_record("tags", tag, **extras)
+                    tag_id, inserted = self.get_related_record_id("tags", tag, "en")
+                    if inserted:
                         modified_upstream = True
                     if tag_id is not None:
                         new_tag_ids.append(tag_id)
-                        if tag_id not in existing_tag_ids:
-                            self.insert_cross_record("records_x_tags", "tags", tag_id, record["record_id"])
-                            modified_upstream = True
-                for eid in existing_tag_ids:
-                    if eid not in new_tag_ids:
-                        modified_upstream = True
-                        self.delete_one_related_record("records_x_tags", eid, record["record_id"])
+                added_ids = [rid for rid in new_tag_ids if rid not in existing_tag_ids]
+                removed_ids = [eid for eid in existing_tag_ids if eid not in new_tag_ids]
+                if added_ids or removed_ids:
+                    modified_upstream = True
+                self.insert_cross_records("records_x_tags", "tags", added_ids, record["record_id"])
+                self.delete_related_records("records_x_tags", removed_ids, record["record_id"])
 
             if "tags_fr" in record:
                 if not isinstance(record["tags_fr"], list):
                     record["tags_fr"] = [record["tags_fr"]]
-                existing_tag_recs = self.get_multiple_records("records_x_tags", "tag_id", "record_id",
-                                                              record["record_id"])
-                existing_tag_ids_all = [e["tag_id"] for e in existing_tag_recs]
-                existing_tag_ids = existing_tag_ids_all.copy()
-                for eid in existing_tag_ids_all: # remove existing tag ids for en tags
-                    tag = self.get_multiple_records("tags", "language", "tag_id", eid)
-                    if tag[0]["language"] == 'en':
-                        existing_tag_ids.remove(eid)
+                # Existing ids, excluding en tags which are handled separately
+                existing_tag_ids = self.get_related_ids_excluding_language("records_x_tags", "tags", record["record_id"], "en")
                 new_tag_ids = []
                 for tag in record["tags_fr"]:
-                    tag_id = self.get_single_record_id("tags", tag, "and language='fr'")
-                    if tag_id is None:
-                        extras = {"language": "fr"}
-                        tag_id = self.insert_related_record("tags", tag, **extras)
+                    tag_id, inserted = self.get_related_record_id("tags", tag, "fr")
+                    if inserted:
                         modified_upstream = True
                     if tag_id is not None:
                         new_tag_ids.append(tag_id)
-                        if tag_id not in existing_tag_ids:
-                            self.insert_cross_record("records_x_tags", "tags", tag_id, record["record_id"])
-                            modified_upstream = True
-                for eid in existing_tag_ids:
-                    if eid not in new_tag_ids:
-                        modified_upstream = True
-                        self.delete_one_related_record("records_x_tags", eid, record["record_id"])
+                added_ids = [rid for rid in new_tag_ids if rid not in existing_tag_ids]
+                removed_ids = [eid for eid in existing_tag_ids if eid not in new_tag_ids]
+                if added_ids or removed_ids:
+                    modified_upstream = True
+                self.insert_cross_records("records_x_tags", "tags", added_ids, record["record_id"])
+                self.delete_related_records("records_x_tags", removed_ids, record["record_id"])
 
             if "access" in record:
                 if not isinstance(record["access"], list):
@@ -842,19 +1044,17 @@ class DBInterface:
                 existing_access_ids = [e["access_id"] for e in existing_access_recs]
                 new_access_ids = []
                 for access in record["access"]:
-                    access_id = self.get_single_record_id("access", access)
-                    if access_id is None:
-                        access_id = self.insert_related_record("access", access)
+                    access_id, inserted = self.get_related_record_id("access", access)
+                    if inserted:
                         modified_upstream = True
                     if access_id is not None:
                         new_access_ids.append(access_id)
-                        if access_id not in existing_access_ids:
-                            self.insert_cross_record("records_x_access", "access", access_id, record["record_id"])
-                            modified_upstream = True
-                for eid in existing_access_ids:
-                    if eid not in new_access_ids:
-                        modified_upstream = True
-                        self.delete_one_related_record("records_x_access", eid, record["record_id"])
+                added_ids = [rid for rid in new_access_ids if rid not in existing_access_ids]
+                removed_ids = [eid for eid in existing_access_ids if eid not in new_access_ids]
+                if added_ids or removed_ids:
+                    modified_upstream = True
+                self.insert_cross_records("records_x_access", "access", added_ids, record["record_id"])
+                self.delete_related_records("records_x_access", removed_ids, record["record_id"])
 
             if "geobboxes" in record:
                 existing_geobbox_recs = self.get_multiple_records("geobbox", "*", "record_id",
@@ -897,10 +1097,10 @@ class DBInterface:
                             self.logger.error("Unable to update geobbox for record id {}: {}".format(record['record_id'], e))
 
                 # Remove any existing boxes that aren't also in the new boxes
-                for eid in existing_geobbox_ids:
-                    if eid not in new_geobbox_ids:
-                        self.delete_row_generic("geobbox", "geobbox_id", eid)
-                        modified_upstream = True
+                removed_ids = [eid for eid in existing_geobbox_ids if eid not in new_geobbox_ids]
+                if removed_ids:
+                    modified_upstream = True
+                    self.delete_rows_generic("geobbox", "geobbox_id", removed_ids)
 
             if "geopoints" in record:
                 existing_geopoint_recs = self.get_multiple_records("geopoint", "*", "record_id",
@@ -923,10 +1123,10 @@ class DBInterface:
                             self.logger.error("Unable to update geopoint for record id {}: {}".format(record['record_id'], e))
 
                 # Remove any existing points that aren't also in the new points
-                for eid in existing_geopoint_ids:
-                    if eid not in new_geopoint_ids:
-                        self.delete_row_generic("geopoint", "geopoint_id", eid)
-                        modified_upstream = True
+                removed_ids = [eid for eid in existing_geopoint_ids if eid not in new_geopoint_ids]
+                if removed_ids:
+                    modified_upstream = True
+                    self.delete_rows_generic("geopoint", "geopoint_id", removed_ids)
 
             if "geoplaces" in record:
                 existing_geoplace_recs = self.get_multiple_records("records_x_geoplace", "*", "record_id",
@@ -952,17 +1152,14 @@ class DBInterface:
                         geoplace_id = self.insert_related_record("geoplace", geoplace["place_name"], **extras)
                     if geoplace_id is not None:
                         new_geoplace_ids.append(geoplace_id)
-                        if geoplace_id not in existing_geoplace_ids:
-                            self.insert_cross_record("records_x_geoplace", "geoplace", geoplace_id, record["record_id"])
-
-                for eid in existing_geoplace_ids:
-                    if eid not in new_geoplace_ids:
-                        records_x_geoplace_id = \
-                            self.get_multiple_records("records_x_geoplace", "records_x_geoplace_id", "record_id",
-                                                      record["record_id"], " and geoplace_id='"
-                                                      + str(eid) + "'")[0]["records_x_geoplace_id"]
-                        self.delete_row_generic("records_x_geoplace", "records_x_geoplace_id", records_x_geoplace_id)
-                        modified_upstream = True
+                added_ids = [rid for rid in new_geoplace_ids if rid not in existing_geoplace_ids]
+                self.insert_cross_records("records_x_geoplace", "geoplace", added_ids, record["record_id"])
+
+                removed_ids = [eid for eid in existing_geoplace_ids if eid not in new_geoplace_ids]
+                if removed_ids:
+                    modified_upstream = True
+                    self.delete_rows_generic("records_x_geoplace", "geoplace_id", removed_ids,
+                                             "and record_id=" + str(record["record_id"]))
 
             if "geofiles" in record:
                 existing_geofile_recs = self.get_multiple_records("geofile", "*", "record_id",
@@ -979,10 +1176,10 @@ class DBInterface:
                         if geofile_id is not None:
                             new_geofile_ids.append(geofile_id)
                 # Remove any existing files that aren't also in the new files
-                for eid in existing_geofile_ids:
-                    if eid not in new_geofile_ids:
-                        self.delete_row_generic("geofile", "geofile_id", eid)
-                        modified_upstream = True
+                removed_ids = [eid for eid in existing_geofile_ids if eid not in new_geofile_ids]
+                if removed_ids:
+                    modified_upstream = True
+                    self.delete_rows_generic("geofile", "geofile_id", removed_ids)
 
             if len(domain_metadata) > 0:
                 # TODO Add deletion for domain metadata
@@ -993,9 +1190,7 @@ class DBInterface:
                         field_pieces = field_uri.split("#")
                         domain_schema = field_pieces[0]
                         field_name = field_pieces[1]
-                        schema_id = self.get_single_record_id("domain_schemas", domain_schema)
-                        if schema_id is None:
-                            schema_id = self.insert_related_record("domain_schemas", domain_schema)
+                        schema_id, inserted = self.get_related_record_id("domain_schemas", domain_schema)
                         if not isinstance(domain_metadata[field_uri], list):
                             domain_metadata[field_uri] = [domain_metadata[field_uri]]
                         for field_value in domain_metadata[field_uri]:
@@ -1008,10 +1203,35 @@ class DBInterface:
 
         return None
 
+    def write_records(self, records, repo):
+        """ Write a batch of records in one transaction, falling back to one at a time if the batch fails """
+        records = [record for record in records if record is not None]
+        if not records:
+            return None
+        failed = []
+        try:
+            with self.transaction():
+                for record in records:
+                    # On postgres an error in one record would abort the whole batch, so each gets a savepoint
+                    with self.savepoint() as succeeded:
+                        self.write_record(record, repo)
+                    if not succeeded[0]:
+                        failed.append(record)
+        except Exception as e:
+            self.logger.error("Unable to write batch of {} records, retrying one at a time: {}".format(len(records), e))
+            failed = records
+        for record in failed:
+            try:
+                self.write_record(record, repo)
+            except Exception as e:
+                self.logger.error("Unable to write record {}: {}".format(record.get("identifier"), e))
+
+        return None
+
     def get_stale_records(self, stale_timestamp, repo_id, max_records_updated_per_run):
         con = self.getConnection()
         records = []
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
             cur.execute(self._prep("""SELECT recs.record_id, recs.title, recs.pub_date, recs.series
                 , recs.modified_timestamp, recs.local_identifier, recs.item_url
@@ -1019,15 +1239,41 @@ class DBInterface:
                 FROM records recs, repositories repos
                 where recs.repository_id = repos.repository_id and recs.modified_timestamp < ? 
                 and repos.repository_id = ? and recs.deleted = 0
+                ORDER BY recs.modified_timestamp
                 LIMIT ?"""), (stale_timestamp, repo_id, max_records_updated_per_run))
             if cur is not None:
                 records = cur.fetchall()
 
         return records
 
+    def touch_records(self, record_ids, modified_timestamp=None):
+        """ touch_record() for many records, in one transaction; an old modified_timestamp queues them for updating instead """
+        if not record_ids:
+            return True
+        con = self.getConnection()
+        now = time.time() if modified_timestamp is None else modified_timestamp
+        with self.transaction():
+            cur = self.getCursor(con)
+            try:
+                cur.executemany(self._prep("UPDATE records set modified_timestamp = ? where record_id = ?"),
+                                [(now, record_id) for record_id in record_ids])
+            except:
+                self.logger.error("Unable to update modified_timestamp for {} records".format(len(record_ids)))
+                return False
+
+        return True
+
+    def set_source_modified_timestamp(self, record_id, source_modified_timestamp):
+        """ Save when the source last changed the item that was fetched for this record, eg. a Dataverse updatedAt """
+        con = self.getConnection()
+        with self.transaction():
+            cur = self.getCursor(con)
+            cur.execute(self._prep("UPDATE records set source_modified_timestamp = ? where record_id = ?"),
+                        (int(source_modified_timestamp), record_id))
+
     def touch_record(self, record):
         con = self.getConnection()
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
             try:
                 cur.execute(self._prep("UPDATE records set modified_timestamp = ? where record_id = ?"),
@@ -1042,7 +1288,7 @@ class DBInterface:
         record_id = self.get_single_record_id("records", local_identifier, "and repository_id=" + str(repo_id))
         if record_id is None:
             con = self.getConnection()
-            with con:
+            with self.transaction():
                 cur = self.getCursor(con)
                 try:
                     cur.execute(self._prep(
@@ -1054,9 +1300,35 @@ class DBInterface:
 
         return None
 
+    def write_headers(self, local_identifiers, repo_id):
+        """ Create headers for any of these identifiers not already in the repository, in one transaction """
+        existing = set(record["local_identifier"] for record in
+                       self.get_multiple_records("records", "local_identifier", "repository_id", repo_id))
+        new_identifiers = []
+        for local_identifier in local_identifiers:
+            if local_identifier not in existing:
+                existing.add(local_identifier)
+                new_identifiers.append(local_identifier)
+        if not new_identifiers:
+            return None
+
+        con = self.getConnection()
+        with self.transaction():
+            cur = self.getCursor(con)
+            try:
+                cur.executemany(self._prep(
+                    "INSERT INTO records (title, title_fr, pub_date, series, modified_timestamp, local_identifier"
+                    ", item_url, repository_id, upstream_modified_timestamp) VALUES(?,?,?,?,?,?,?,?,?)"),
+                    [("", "", "", "", 0, local_identifier, "", repo_id, time.time()) for local_identifier in
+                     new_identifiers])
+            except self.dblayer.IntegrityError as e:
+                self.logger.error("Error creating record headers: {}".format(e))
+
+        return None
+
     def update_record_upstream_modified(self, record):
         con = self.getConnection()
-        with con:
+        with self.transaction():
             cur = self.getCursor(con)
             try:
                 cur.execute(self._prep("UPDATE records set upstream_modified_timestamp = ?, geodisy_harvested = 0 where record_id = ?")
@@ -1,7 +1,6 @@
 from harvester.HarvestRepository import HarvestRepository
-from harvester.rate_limited import rate_limited
-import urllib
-from dateutil import parser
+from harvester.DateNormalizer import DateNormalizer
+from dateutil import tz
 import time
 import json
 import xml.etree.ElementTree as ET
@@ -10,10 +9,15 @@ import xml.etree.ElementTree as ET
 class DataStreamRepository(HarvestRepository):
     """ DataStream Repository """
 
+    sitemap_url = "https://datastream.org/dataset/sitemap.xml"
+    dataset_url = "https://datastream.org/dataset/"
+
     def setRepoParams(self, repoParams):
         self.metadataprefix = "datastream"
         super(DataStreamRepository, self).setRepoParams(repoParams)
         self.domain_metadata = []
+        # Sitemap lastmod of each new or changed item, saved once the item has been fetched
+        self.sitemap_lastmods = {}
 
     def _crawl(self):
         kwargs = {
@@ -29,16 +33,33 @@ class DataStreamRepository(HarvestRepository):
         }
         self.repository_id = self.db.update_repo(**kwargs)
 
+        self.sitemap_lastmods = {}
         try:
-            response = urllib.request.urlopen('https://datastream.org/dataset/sitemap.xml')
-            response_xml = ET.parse(response)
-            root = response_xml.getroot()
-            results = []
+            existing_records = {}
+            for record in self.db.get_multiple_records("records", "record_id, local_identifier, source_modified_timestamp",
+                                                       "repository_id", self.repository_id, "and deleted=0"):
+                existing_records[record["local_identifier"]] = (record["record_id"], record["source_modified_timestamp"])
+            new_identifiers = []
+            changed_ids = []
+            unchanged_ids = []
 
             item_count = 0
-            for child in root:
-                item_identifier = child[0].text.split("https://datastream.org/dataset/")[1]
-                result = self.db.write_header(item_identifier, self.repository_id)
+            for loc, lastmod in self._read_sitemap(self.sitemap_url):
+                if not loc.startswith(self.dataset_url):
+                    continue
+                item_identifier = loc[len(self.dataset_url):]
+                if item_identifier not in existing_records:
+                    new_identifiers.append(item_identifier)
+                    if lastmod is not None:
+                        self.sitemap_lastmods[item_identifier] = lastmod
+                elif lastmod is not None:
+                    # Compared with the lastmod of the last successful fetch, as a failed one also touches the record
+                    record_id, source_modified_timestamp = existing_records[item_identifier]
+                    if lastmod > source_modified_timestamp:
+                        changed_ids.append(record_id)
+                        self.sitemap_lastmods[item_identifier] = lastmod
+                    else:
+                        unchanged_ids.append(record_id)
                 item_count = item_count + 1
                 if (item_count % self.update_log_after_numitems == 0):
                     tdelta = time.time() - self.tstart + 0.1
@@ -48,16 +69,65 @@ class DataStreamRepository(HarvestRepository):
                                                                                                item_count / tdelta))
             self.logger.info("Found {} items in feed".format(item_count))
 
+            self.db.write_headers(new_identifiers, self.repository_id)
+            # Changed datasets are queued to be updated before any that are only due by age
+            self.db.touch_records(changed_ids, 1)
+            self.db.touch_records(unchanged_ids)
+            self.logger.info("{} new, {} changed and {} unchanged items since they were last updated".format(
+                len(new_identifiers), len(changed_ids), len(unchanged_ids)))
+
             return True
 
         except Exception as e:
             self.logger.error("Updating DataStream Repository failed: {}".format(e))
-            self.error_count = self.error_count + 1
-            if self.error_count < self.abort_after_numerrors:
+            if self._count_error():
                 return True
 
         return False
 
+    def _read_sitemap(self, url):
+        """ Stream (loc, lastmod timestamp) pairs from a sitemap, following the sitemaps listed by a sitemap index """
+        response = self.http_session.get(url, stream=True)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        sitemaps = []
+        loc = None
+        lastmod = None
+        root = None
+        for event, element in ET.iterparse(response.raw, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = element
+                continue
+            tag = element.tag.rsplit("}", 1)[-1]
+            if tag == "loc":
+                loc = (element.text or "").strip()
+            elif tag == "lastmod":
+                lastmod = self._parse_lastmod(element.text)
+            elif tag == "url":
+                yield loc, lastmod
+                loc, lastmod = None, None
+                # Finished entries stay attached to the root element unless they are removed from it
+                root.clear()
+            elif tag == "sitemap":
+                sitemaps.append(loc)
+                loc, lastmod = None, None
+                root.clear()
+        response.close()
+
+        for sitemap in sitemaps:
+            for item in self._read_sitemap(sitemap):
+                yield item
+
+    def _parse_lastmod(self, lastmod):
+        try:
+            lastmod_date = DateNormalizer.parse(lastmod.strip())
+        except:
+            return None
+        if lastmod_date.tzinfo is None:
+            lastmod_date = lastmod_date.replace(tzinfo=tz.tzutc())
+        return lastmod_date.timestamp()
+
     def format_datastream_to_oai(self, datastream_dcat_json):
 
         datastream_record = datastream_dcat_json
@@ -86,7 +156,7 @@ class DataStreamRepository(HarvestRepository):
                 record["publisher"] = datastream_record["publisher"]["name"]
 
         if ("datePublished" in datastream_record) and datastream_record["datePublished"]:
-            record["pub_date"] = parser.parse(datastream_record["datePublished"]).strftime('%Y-%m-%d')
+            record["pub_date"] = DateNormalizer.parse(datastream_record["datePublished"]).strftime('%Y-%m-%d')
 
         if ("identifier" in datastream_record) and datastream_record["identifier"]:
             if ("url" in datastream_record["identifier"]) and datastream_record["identifier"]["url"]:
@@ -112,23 +182,35 @@ class DataStreamRepository(HarvestRepository):
 
         return record
 
-    @rate_limited(5)
+    def _save_source_timestamp(self, record):
+        """ Save the sitemap lastmod of an item that has now been fetched """
+        lastmod = self.sitemap_lastmods.pop(record["local_identifier"], None)
+        if lastmod is not None:
+            self.db.set_source_modified_timestamp(record["record_id"], lastmod)
+
     def _update_record(self, record):
         try:
             identifier = record['local_identifier']
             item_dcat_json_url = "https://datastream.org/dataset/" + identifier + ".dcat.json"
             try:
-                item_response = urllib.request.urlopen(item_dcat_json_url)
+                item_response = self._conditional_get(record, item_dcat_json_url)
+                if item_response is None:
+                    # Unchanged since it was last fetched
+                    self._save_source_timestamp(record)
+                    return True
+                item_response.raise_for_status()
             except Exception as e:
                 # Exception means this URL was not found
                 self.db.delete_record(record)
                 return True
-            item_response_content = item_response.read().decode('utf-8')
+            item_response_content = item_response.content.decode('utf-8')
             item_json = json.loads(item_response_content)
 
             oai_record = self.format_datastream_to_oai(item_json)
             if oai_record:
                 self.db.write_record(oai_record, self)
+                self._save_validators(record, item_dcat_json_url, item_response)
+                self._save_source_timestamp(record)
             return True
 
         except Exception as e:
@@ -140,8 +222,7 @@ class DataStreamRepository(HarvestRepository):
                     pass
             # Touch the record so we do not keep requesting it on every run
             self.db.touch_record(record)
-            self.error_count = self.error_count + 1
-            if self.error_count < self.abort_after_numerrors:
+            if self._count_error():
                 return True
 
         return False
@@ -1,21 +1,30 @@
 from harvester.HarvestRepository import HarvestRepository
-import requests
+from harvester.DateNormalizer import DateNormalizer
+import itertools
 import time
 import json
 import re
 import os.path
-from dateutil import parser
 
 
 class DataverseRepository(HarvestRepository):
     """ DataverseRepository Repository """
 
+    search_rows = 1000
+    # Resolver URLs a dataset's persistent URL may use, and the global ID protocol each stands for
+    persistent_url_pattern = re.compile(r"^https?://(?:(?:dx\.)?doi\.org/(?P<doi>.+)|hdl\.handle\.net/(?P<hdl>.+))$")
+
     def setRepoParams(self, repoParams):
         self.metadataprefix = "dataverse"
         super(DataverseRepository, self).setRepoParams(repoParams)
         self.domain_metadata = []
         self.params = {
         }
+        self.dataverse_names = {}
+        # Search API updatedAt by persistent URL and global ID, and by record_id for records already matched to one,
+        # saved for each record once its dataset has been fetched
+        self.search_updated = {}
+        self.source_timestamps = {}
         self.geofile_extensions = [".tif", ".tiff",".xyz", ".png", ".aux.xml",".tab",".twf",".tifw", ".tiffw",".wld",
                                   ".tif.prj",".tfw", ".geojson",".shp",".gpkg", ".shx", ".dbf", ".sbn",".prj", ".csv", ".txt", ".zip"]
 
@@ -41,51 +50,168 @@ class DataverseRepository(HarvestRepository):
                 dataverse_id = self.set
             item_count = self.get_datasets_from_dataverse_id(dataverse_id, str(dataverse_id), 0, self.dataverses_list)
             self.logger.info("Found {} items in feed".format(item_count))
+            if self.bulk_crawl:
+                self._refresh_changed_datasets()
             return True
         except Exception as e:
             self.logger.error("Updating Dataverse Repository failed: {}".format(e))
-            self.error_count = self.error_count + 1
-            if self.error_count < self.abort_after_numerrors:
+            if self._count_error():
                 return True
 
         return False
 
     def get_datasets_from_dataverse_id(self, dataverse_id, dataverse_hierarchy, item_count, dataverses_list=None):
-        response = requests.get(self.url.replace("%id%", str(dataverse_id)), verify=False)
-        records = response.json()
-        for record in records["data"]:
-            if record["type"] == "dataset":
-                item_identifier = record["id"]
-                combined_identifier = str(item_identifier)
-                dataverse_hierarchy_split = [x.strip() for x in dataverse_hierarchy.split("_")]
-                if len(dataverse_hierarchy_split) > 1:
-                    # Write dataverse_hierarchy - minus the repository id - plus identifier as local_identifier
-                    dataverse_hierarchy_string = "_".join(dataverse_hierarchy_split[1:])
-                    combined_identifier = combined_identifier + "_" + dataverse_hierarchy_string
-                result = self.db.write_header(combined_identifier, self.repository_id)
-                item_count = item_count + 1
-                if (item_count % self.update_log_after_numitems == 0):
-                    tdelta = time.time() - self.tstart + 0.1
-                    self.logger.info("Done {} item headers after {} ({:.1f} items/sec)".format(item_count,self.formatter.humanize(
-                                                                                               tdelta),item_count / tdelta))
-            elif record["type"] == "dataverse":
-                if dataverses_list and record["id"] not in dataverses_list:
-                    # If a dataverses_list is specified, ignore any dataverses not in it
-                    pass
-                else:
-                    # Recursive call to get children of this dataverse
-                    # Append the dataverse id to the overall dataverse_hierarchy
-                    item_count = self.get_datasets_from_dataverse_id(record["id"], dataverse_hierarchy + "_" + str(record["id"]), item_count)
-        return item_count
+        """ Walk the dataverse tree breadth first, fetching up to crawl_workers sibling dataverses at once """
+        identifiers = []
+        names = {}
+        level = [(dataverse_id, dataverse_hierarchy)]
+        while level:
+            next_level = []
+            contents = self._fetch_pages(self.get_dataverse_contents, [child_id for child_id, _ in level])
+            for (parent_id, parent_hierarchy), records in zip(level, contents):
+                for record in records:
+                    if record["type"] == "dataset":
+                        identifiers.append(self.get_combined_identifier(record["id"], parent_hierarchy))
+                    elif record["type"] == "dataverse":
+                        if dataverses_list and parent_id == dataverse_id and record["id"] not in dataverses_list:
+                            # If a dataverses_list is specified, ignore any top level dataverses not in it
+                            continue
+                        if record.get("title"):
+                            names[record["id"]] = record["title"]
+                        # Append the dataverse id to the overall dataverse_hierarchy
+                        next_level.append((record["id"], parent_hierarchy + "_" + str(record["id"])))
+            level = next_level
+            self.logger.info("Found {} items after {}, with {} dataverses left to visit at the next level".format(
+                len(identifiers), self.formatter.humanize(time.time() - self.tstart + 0.1), len(level)))
+
+        self.db.write_headers(identifiers, self.repository_id)
+        # Remember the names of the dataverses seen, so formatting records does not have to request them again
+        self.db.set_dataverse_names(self.repository_id, names)
+        self.dataverse_names.update(names)
+        return item_count + len(identifiers)
+
+    def get_dataverse_contents(self, dataverse_id):
+        response = self.http_session.get(self.url.replace("%id%", str(dataverse_id)), verify=False)
+        return response.json()["data"]
+
+    def get_combined_identifier(self, item_identifier, dataverse_hierarchy):
+        combined_identifier = str(item_identifier)
+        dataverse_hierarchy_split = [x.strip() for x in dataverse_hierarchy.split("_")]
+        if len(dataverse_hierarchy_split) > 1:
+            # Write dataverse_hierarchy - minus the repository id - plus identifier as local_identifier
+            dataverse_hierarchy_string = "_".join(dataverse_hierarchy_split[1:])
+            combined_identifier = combined_identifier + "_" + dataverse_hierarchy_string
+        return combined_identifier
 
     def get_dataverse_name_from_dataverse_id(self, dataverse_id):
+        """ Dataverse name from memory or the database, only requesting it if it is missing or older than dataverse_name_days """
+        if dataverse_id in self.dataverse_names:
+            return self.dataverse_names[dataverse_id]
+        name = self.db.get_dataverse_name(self.repository_id, dataverse_id,
+                                          time.time() - self.dataverse_name_days * 86400)
+        if name is None:
+            name = self.fetch_dataverse_name(dataverse_id)
+            if name is None:
+                # Ask again next time rather than remembering the failure
+                return None
+            self.db.set_dataverse_names(self.repository_id, {dataverse_id: name})
+        self.dataverse_names[dataverse_id] = name
+        return name
+
+    def fetch_dataverse_name(self, dataverse_id):
         try:
-            response = requests.get(self.url.replace("%id%/contents", str(dataverse_id)), verify=False)
-            record = response.json()
-            return record["data"]["name"]
+            return self.fetch_dataverse(dataverse_id)["name"]
         except Exception as e:
-            print(e)
+            self.logger.error("Unable to get the name of dataverse {}: {}".format(dataverse_id, e))
+
+    def fetch_dataverse(self, dataverse_id):
+        response = self.http_session.get(self.url.replace("%id%/contents", str(dataverse_id)), verify=False)
+        return response.json()["data"]
+
+    def _search_datasets(self, start, subtree=None):
+        params = {"q": "*", "type": "dataset", "per_page": self.search_rows, "start": start, "sort": "date",
+                  "order": "asc"}
+        if subtree:
+            params["subtree"] = subtree
+        response = self.http_session.get(self.url.replace("dataverses/%id%/contents", "search"), params=params,
+                                         verify=False)
+        return response.json()["data"]
 
+    def _refresh_changed_datasets(self):
+        """ Fetch only the datasets the Search API reports as updated since their record was last fetched """
+        self.search_updated = {}
+        self.source_timestamps = {}
+        subtree = None
+        if self.set != "":
+            subtree = self.fetch_dataverse(self.set)["alias"]
+        first_page = self._search_datasets(0, subtree)
+        # The installation may return fewer rows per page than asked for
+        page_size = len(first_page["items"]) or self.search_rows
+        pages = itertools.chain([first_page], self._fetch_pages(lambda start: self._search_datasets(start, subtree),
+                                                                range(page_size, first_page["total_count"], page_size)))
+        updated = self.search_updated
+        dataset_count = 0
+        for page in pages:
+            for item in page["items"]:
+                if item.get("url") and item.get("updatedAt"):
+                    dataset_count += 1
+                    updated[item["url"]] = DateNormalizer.parse(item["updatedAt"]).timestamp()
+                    if item.get("global_id"):
+                        updated[item["global_id"]] = updated[item["url"]]
+
+        # Records are matched to search results by their persistent URL, or failing that the global ID it resolves,
+        # as search results do not include dataset IDs
+        records = self.db.get_multiple_records("records", "record_id, local_identifier, item_url, modified_timestamp, "
+                                               "source_modified_timestamp", "repository_id", self.repository_id,
+                                               "and deleted = 0")
+        changed = []
+        unchanged = []
+        matched = 0
+        unmatched = 0
+        for record in records:
+            item_updated = updated.get(record["item_url"])
+            if item_updated is None and record["item_url"]:
+                item_updated = updated.get(self.get_global_id(record["item_url"]))
+            if record["modified_timestamp"] == 0:
+                # Never fetched, so there is no persistent URL to match yet
+                changed.append(record)
+            elif item_updated is None:
+                unmatched += 1
+            elif item_updated > record["source_modified_timestamp"]:
+                # Compared with the updatedAt of the last successful fetch, as a failed one also touches the record
+                matched += 1
+                self.source_timestamps[record["record_id"]] = item_updated
+                changed.append(record)
+            else:
+                matched += 1
+                unchanged.append(record["record_id"])
+        self.db.touch_records(unchanged)
+        self.logger.info("Search API listed {} datasets, matching {} of {} fetched records: {} changed, "
+                         "{} unchanged".format(dataset_count, matched, matched + unmatched, len(changed), len(unchanged)))
+        if unmatched and not matched:
+            self.logger.error("No records matched the Search API results by persistent URL or global ID")
+
+        # Like update_stale_records, fetch at most max_records_updated_per_run, oldest first; the rest are left as
+        # they are, so later runs pick them up
+        changed.sort(key=lambda record: record["modified_timestamp"])
+        if len(changed) > int(self.max_records_updated_per_run):
+            self.logger.info("Fetching the first {} changed records".format(self.max_records_updated_per_run))
+            changed = changed[:int(self.max_records_updated_per_run)]
+
+        tstart = time.time()
+        record_count = self._update_records(changed, tstart)
+        self.logger.info("Updated {} items in {} ({:.1f} items/sec)".format(record_count, self.formatter.humanize(
+            time.time() - tstart), record_count / (time.time() - tstart + 0.1)))
+
+
+    def get_global_id(self, persistent_url):
+        """ Global ID, eg. doi:10.5072/FK2/ABC, for a doi.org or hdl.handle.net persistent URL """
+        match = self.persistent_url_pattern.match(persistent_url)
+        if match is None:
+            return None
+        if match.group("doi"):
+            return "doi:" + match.group("doi")
+        return "hdl:" + match.group("hdl")
 
     def format_dataverse_to_oai(self, dataverse_record):
         record = {}
@@ -102,7 +228,10 @@ class DataverseRepository(HarvestRepository):
             # dataset is direct child of sub-dataverse(s)
             record["series"] = []
             for dataverse_id in identifier_split[1:]:
-                record["series"].append(self.get_dataverse_name_from_dataverse_id(int(dataverse_id)))
+                dataverse_name = self.get_dataverse_name_from_dataverse_id(int(dataverse_id))
+                if dataverse_name is None:
+                    raise ValueError("no name for dataverse {}".format(dataverse_id))
+                record["series"].append(dataverse_name)
             record["series"] = " // ".join(record["series"]) # list of sub-dataverse names
 
         if "latestVersion" not in dataverse_record:
@@ -240,13 +369,26 @@ class DataverseRepository(HarvestRepository):
 
         return record
 
+    def _save_source_timestamp(self, record, persistent_url):
+        """ Save the updatedAt the Search API listed for a record whose dataset has now been fetched """
+        source_timestamp = self.source_timestamps.pop(record["record_id"], None)
+        if source_timestamp is None and persistent_url:
+            source_timestamp = self.search_updated.get(persistent_url) or self.search_updated.get(
+                self.get_global_id(persistent_url))
+        if source_timestamp is not None:
+            self.db.set_source_modified_timestamp(record["record_id"], source_timestamp)
+
     def _update_record(self, record):
         try:
             identifier_split = record['local_identifier'].split("_")
             item_identifier = identifier_split[0]
             record_url = self.url.replace("dataverses/%id%/contents", "datasets/") + item_identifier
             try:
-                item_response = requests.get(record_url)
+                item_response = self._conditional_get(record, record_url)
+                if item_response is None:
+                    # Unchanged since it was last fetched
+                    self._save_source_timestamp(record, None)
+                    return True
                 dataverse_record = item_response.json()["data"]
                 dataverse_record["combined_identifier"] = record['local_identifier']
             except:
@@ -259,6 +401,9 @@ class DataverseRepository(HarvestRepository):
                 if "deleted" in oai_record:
                     # This record has been deaccessioned, remove it from the results
                     self.db.delete_record(record)
+                else:
+                    self._save_validators(record, record_url, item_response)
+                    self._save_source_timestamp(record, oai_record["item_url"])
             else:
                     # Some other problem, this record will be updated by a future crawl
                     self.db.touch_record(record)
@@ -272,8 +417,7 @@ class DataverseRepository(HarvestRepository):
                     pass
             # Touch the record so we do not keep requesting it on every run
             self.db.touch_record(record)
-            self.error_count = self.error_count + 1
-            if self.error_count < self.abort_after_numerrors:
+            if self._count_error():
                 return True
 
         return False
@@ -0,0 +1,59 @@
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+import dateparser
+from dateutil import parser
+
+
+class DateNormalizer(object):
+    """ Parse dates from harvested metadata, trying strict ISO 8601 and YYYYMMDD formats before dateutil or dateparser """
+
+    iso_pattern = re.compile(r"^(\d{4})-(\d{2})-(\d{2})"
+                             r"(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d{1,6})\d*)?)?)?"
+                             r"(Z|[+-]\d{2}(?::?\d{2})?)?$")
+    compact_pattern = re.compile(r"^\d{8}$")
+
+    @staticmethod
+    def _strict_parse(datestring):
+        """ Return a datetime for an ISO 8601 or YYYYMMDD string, or None if datestring is anything else or invalid """
+        try:
+            if DateNormalizer.compact_pattern.match(datestring):
+                return datetime.strptime(datestring, "%Y%m%d")
+            match = DateNormalizer.iso_pattern.match(datestring)
+            if match is None:
+                return None
+            year, month, day, hour, minute, second, fraction, offset = match.groups()
+            tzinfo = None
+            if offset == "Z":
+                tzinfo = timezone.utc
+            elif offset is not None:
+                hours, minutes = int(offset[1:3]), int(offset[-2:]) if len(offset) > 3 else 0
+                delta = timedelta(hours=hours, minutes=minutes)
+                tzinfo = timezone(-delta if offset[0] == "-" else delta)
+            return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0),
+                            int((fraction or "0").ljust(6, "0")), tzinfo)
+        except ValueError:
+            return None
+
+    @staticmethod
+    @lru_cache(maxsize=10000)
+    def parse(datestring):
+        """ Drop-in for dateutil's parser.parse(), which is only used when the strict formats do not match """
+        date_object = DateNormalizer._strict_parse(datestring.strip())
+        if date_object is None:
+            date_object = parser.parse(datestring)
+        return date_object
+
+    @staticmethod
+    @lru_cache(maxsize=10000)
+    def normalize(datestring):
+        """ Return datestring as YYYY-MM-DD, falling back to dateparser for free text, or None if it is not a date """
+        date_object = DateNormalizer._strict_parse(datestring.strip())
+        if date_object is None:
+            date_object = dateparser.parse(datestring)
+            if date_object is None:
+                date_object = dateparser.parse(datestring, date_formats=['%Y%m%d'])
+            if date_object is None:
+                return None
+        return date_object.strftime("%Y-%m-%d")
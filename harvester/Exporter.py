@@ -10,6 +10,34 @@ class Exporter(object):
     """ Read records from the database and export to given formats """
 
     __records_per_loop = 500
+    # The gmeta wrapper is written around the streamed entries exactly as json.dumps() would render it
+    __gmeta_header = ('{"@datatype": "GIngest", "@version": "2016-11-09", "ingest_type": "GMetaList", '
+                      '"ingest_data": {"@datatype": "GMetaList", "@version": "2016-11-09", "gmeta": [')
+    __gmeta_footer = ']}}'
+    __related_queries = [
+        ("dc_contributor_author", """SELECT records_x_creators.record_id, creators.creator FROM creators JOIN records_x_creators on records_x_creators.creator_id = creators.creator_id
+            WHERE records_x_creators.record_id IN ({}) AND records_x_creators.is_contributor=0 order by records_x_creators_id asc"""),
+        ("datacite_creatorAffiliation", """SELECT records_x_affiliations.record_id, affiliations.affiliation FROM affiliations JOIN records_x_affiliations on records_x_affiliations.affiliation_id = affiliations.affiliation_id
+            WHERE records_x_affiliations.record_id IN ({}) order by records_x_affiliations_id asc"""),
+        ("dc_contributor", """SELECT records_x_creators.record_id, creators.creator FROM creators JOIN records_x_creators on records_x_creators.creator_id = creators.creator_id
+            WHERE records_x_creators.record_id IN ({}) AND records_x_creators.is_contributor=1 order by records_x_creators_id asc"""),
+        ("frdr_category_en", """SELECT records_x_subjects.record_id, subjects.subject FROM subjects JOIN records_x_subjects on records_x_subjects.subject_id = subjects.subject_id
+            WHERE records_x_subjects.record_id IN ({}) and subjects.language='en' order by records_x_subjects_id asc"""),
+        ("frdr_category_fr", """SELECT records_x_subjects.record_id, subjects.subject FROM subjects JOIN records_x_subjects on records_x_subjects.subject_id = subjects.subject_id
+            WHERE records_x_subjects.record_id IN ({}) and subjects.language='fr' order by records_x_subjects_id asc"""),
+        ("dc_publisher", """SELECT records_x_publishers.record_id, publishers.publisher FROM publishers JOIN records_x_publishers on records_x_publishers.publisher_id = publishers.publisher_id
+            WHERE records_x_publishers.record_id IN ({}) order by records_x_publishers_id asc"""),
+        ("dc_rights", """SELECT records_x_rights.record_id, rights.rights FROM rights JOIN records_x_rights on records_x_rights.rights_id = rights.rights_id
+            WHERE records_x_rights.record_id IN ({}) order by records_x_rights_id asc"""),
+        ("dc_description_en", "SELECT record_id, description FROM descriptions WHERE record_id IN ({}) and language='en' order by description_id asc"),
+        ("dc_description_fr", "SELECT record_id, description FROM descriptions WHERE record_id IN ({}) and language='fr' order by description_id asc"),
+        ("frdr_keyword_en", """SELECT records_x_tags.record_id, tags.tag FROM tags JOIN records_x_tags on records_x_tags.tag_id = tags.tag_id
+            WHERE records_x_tags.record_id IN ({}) and tags.language = 'en' order by records_x_tags_id asc"""),
+        ("frdr_keyword_fr", """SELECT records_x_tags.record_id, tags.tag FROM tags JOIN records_x_tags on records_x_tags.tag_id = tags.tag_id
+            WHERE records_x_tags.record_id IN ({}) and tags.language = 'fr' order by records_x_tags_id asc"""),
+        ("frdr_access", """SELECT records_x_access.record_id, access.access FROM access JOIN records_x_access on records_x_access.access_id = access.access_id
+            WHERE records_x_access.record_id IN ({}) order by records_x_access_id asc""")
+    ]
 
     def __init__(self, db, log, finalconfig):
         self.db = db
@@ -22,17 +50,6 @@ class Exporter(object):
             from psycopg2.extras import DictCursor
             from psycopg2.extras import DictRow
 
-    def _rows_to_dict(self, cursor):
-        newdict = []
-        if cursor:
-            for r in cursor:
-                if r:
-                    if isinstance(r, list):
-                        newdict.append(r[0])
-                    else:
-                        newdict.append(r)
-        return newdict
-
     def _generate_gmeta(self, export_filepath, temp_filepath, only_new_records, start_time):
         self.logger.info("Exporter: generate_gmeta called")
         self.output_buffer = []
@@ -72,196 +89,169 @@ class Exporter(object):
         records_assembled = 0
         self.batch_number = 1
         self.buffer_size = 0
-        for row in records_cursor:
-            if self.buffer_size > buffer_limit:
-                self._write_batch(export_filepath, temp_filepath, start_time)
-
-            record = (dict(zip(
+        self.gmeta_file = None
+        self.gmeta_basename = None
+        while True:
+            rows = records_cursor.fetchmany(self.__records_per_loop)
+            if not rows:
+                break
+
+            records = []
+            for row in rows:
+                record = (dict(zip(
+
+                    ['record_id', 'title', 'title_fr', 'pub_date', 'series', 'source_url', 'deleted', 'local_identifier',
+                     'item_url', 'modified_timestamp',
+                     'repository_url', 'repository_name', 'repository_thumbnail', 'item_url_pattern',
+                     'last_crawl_timestamp'], row)))
+                record["deleted"] = int(record["deleted"])
+
+                if record["item_url"] == "" and record["modified_timestamp"] != 0:
+                    record["item_url"] = self.db.construct_local_url(record)
+
+                if record.get("item_url") is None:
+                    continue
 
-                ['record_id', 'title', 'title_fr', 'pub_date', 'series', 'source_url', 'deleted', 'local_identifier',
-                 'item_url', 'modified_timestamp',
-                 'repository_url', 'repository_name', 'repository_thumbnail', 'item_url_pattern',
-                 'last_crawl_timestamp'], row)))
-            record["deleted"] = int(record["deleted"])
+                if record["deleted"] == 1:
+                    deleted.append(record["item_url"])
+                    continue
 
-            if record["item_url"] == "" and record["modified_timestamp"] != 0:
-                record["item_url"] = self.db.construct_local_url(record)
+                if ((record["title"] is None or len(record["title"]) == 0) and
+                    (record["title_fr"] is None or len(record["title_fr"]) == 0)):
+                    continue
 
-            if record.get("item_url") is None:
-                continue
-                
-            if record["deleted"] == 1:
-                deleted.append(record["item_url"])
-                continue
+                records.append(record)
 
-            if ((record["title"] is None or len(record["title"]) == 0) and 
-                (record["title_fr"] is None or len(record["title_fr"]) == 0)):
+            if not records:
                 continue
+            related = self._prefetch_related([record["record_id"] for record in records])
 
-            con = self.db.getConnection()
-            with con:
-                if self.db.getType() == "sqlite":
-                    from sqlite3 import Row
-                    con.row_factory = Row
-                    litecur = con.cursor()
-                elif self.db.getType() == "postgres":
-                    litecur = con.cursor(cursor_factory=None)
-
-                # TODO update this to export new geospatial elements
-                litecur.execute(self.db._prep("SELECT coordinate_type, lat, lon FROM geospatial WHERE record_id=?"),
-                                (record["record_id"],))
-                geodata = litecur.fetchall()
-                record["frdr_geospatial"] = []
-                polycoordinates = []
-
-                try:
-                    for coordinate in geodata:
-                        if coordinate[0] == "Polygon":
-                            polycoordinates.append([float(coordinate[1]), float(coordinate[2])])
-                        else:
-                            record["frdr_geospatial"].append({"frdr_geospatial_type": "Feature",
-                                                              "frdr_geospatial_geometry": {
-                                                                  "frdr_geometry_type": coordinate[0],
-                                                                  "frdr_geometry_coordinates": [float(coordinate[1]),
-                                                                                                float(coordinate[2])]}})
-                except:
-                    pass
-
-                if polycoordinates:
-                    record["frdr_geospatial"].append({"frdr_geospatial_type": "Feature",
-                                                      "frdr_geospatial_geometry": {"frdr_geometry_type": "Polygon",
-                                                                                   "frdr_geometry_coordinates": polycoordinates}})
-
-            with con:
-                if self.db.getType() == "sqlite":
-                    con.row_factory = lambda cursor, row: row[0]
-                    litecur = con.cursor()
-                elif self.db.getType() == "postgres":
-                    litecur = con.cursor(cursor_factory=DictCursor)
-
-                # attach the other values to the dict
-                litecur.execute(self.db._prep("""SELECT creators.creator FROM creators JOIN records_x_creators on records_x_creators.creator_id = creators.creator_id
-                    WHERE records_x_creators.record_id=? AND records_x_creators.is_contributor=0 order by records_x_creators_id asc"""),
-                                (record["record_id"],))
-                record["dc_contributor_author"] = self._rows_to_dict(litecur)
-
-                litecur.execute(self.db._prep("""SELECT affiliations.affiliation FROM affiliations JOIN records_x_affiliations on records_x_affiliations.affiliation_id = affiliations.affiliation_id
-                    WHERE records_x_affiliations.record_id=?"""), (record["record_id"],))
-                record["datacite_creatorAffiliation"] = self._rows_to_dict(litecur)
-
-                litecur.execute(self.db._prep("""SELECT creators.creator FROM creators JOIN records_x_creators on records_x_creators.creator_id = creators.creator_id
-                    WHERE records_x_creators.record_id=? AND records_x_creators.is_contributor=1 order by records_x_creators_id asc"""),
-                                (record["record_id"],))
-                record["dc_contributor"] = self._rows_to_dict(litecur)
-
-                litecur.execute(self.db._prep("""SELECT subjects.subject FROM subjects JOIN records_x_subjects on records_x_subjects.subject_id = subjects.subject_id
-                    WHERE records_x_subjects.record_id=? and subjects.language='en'"""), (record["record_id"],))
-                record["frdr_category_en"] = self._rows_to_dict(litecur)
-
-
-                litecur.execute(self.db._prep("""SELECT subjects.subject FROM subjects JOIN records_x_subjects on records_x_subjects.subject_id = subjects.subject_id
-                    WHERE records_x_subjects.record_id=? and subjects.language='fr'"""), (record["record_id"],))
-                record["frdr_category_fr"] = self._rows_to_dict(litecur)
-
-                litecur.execute(self.db._prep("""SELECT publishers.publisher FROM publishers JOIN records_x_publishers on records_x_publishers.publisher_id = publishers.publisher_id
-                    WHERE records_x_publishers.record_id=?"""), (record["record_id"],))
-                record["dc_publisher"] = self._rows_to_dict(litecur)
-
-                litecur.execute(self.db._prep("""SELECT rights.rights FROM rights JOIN records_x_rights on records_x_rights.rights_id = rights.rights_id
-                                                       WHERE records_x_rights.record_id=?"""), (record["record_id"],))
-                record["dc_rights"] = self._rows_to_dict(litecur)
-
-                litecur.execute(
-                    self.db._prep("SELECT description FROM descriptions WHERE record_id=? and language='en' "),
-                    (record["record_id"],))
-                record["dc_description_en"] = self._rows_to_dict(litecur)
-
-                litecur.execute(
-                    self.db._prep("SELECT description FROM descriptions WHERE record_id=? and language='fr' "),
-                    (record["record_id"],))
-                record["dc_description_fr"] = self._rows_to_dict(litecur)
-
-                litecur.execute(self.db._prep("""SELECT tags.tag FROM tags JOIN records_x_tags on records_x_tags.tag_id = tags.tag_id
-                    WHERE records_x_tags.record_id=? and tags.language = 'en' """), (record["record_id"],))
-                record["frdr_keyword_en"] = self._rows_to_dict(litecur)
-
-                litecur.execute(self.db._prep("""SELECT tags.tag FROM tags JOIN records_x_tags on records_x_tags.tag_id = tags.tag_id
-                    WHERE records_x_tags.record_id=? and tags.language = 'fr' """), (record["record_id"],))
-                record["frdr_keyword_fr"] = self._rows_to_dict(litecur)
-
-                litecur.execute(self.db._prep("""SELECT access.access FROM access JOIN records_x_access on records_x_access.access_id = access.access_id
-                    WHERE records_x_access.record_id=?"""), (record["record_id"],))
-                record["frdr_access"] = self._rows_to_dict(litecur)
-
-            domain_schemas = {}
-            with con:
-                if self.db.getType() == "sqlite":
-                    from sqlite3 import Row
-                    con.row_factory = Row
-                    litecur = con.cursor()
-                elif self.db.getType() == "postgres":
-                    litecur = con.cursor(cursor_factory=None)
-
-                litecur.execute(self.db._prep(
-                    "SELECT ds.namespace, dm.field_name, dm.field_value FROM domain_metadata dm, domain_schemas ds WHERE dm.schema_id=ds.schema_id and dm.record_id=?"),
-                                (record["record_id"],))
-                for row in litecur:
-                    domain_namespace = str(row[0])
-                    if domain_namespace not in domain_schemas.keys():
-                        current_count = len(domain_schemas)
-                        domain_schemas[domain_namespace] = "frdrcust" + str(current_count + 1)
-                    custom_label = domain_schemas[domain_namespace] + ":" + str(row[1])
-                    record[custom_label] = str(row[2])
-
-            # Convert friendly column names into dc element names
-            record["dc_title_en"] = record["title"]
-            record["dc_title_fr"] = record["title_fr"]
-            record["dc_date"] = record["pub_date"]
-            record["frdr_series"] = record["series"]
-            record["frdr_origin_id"] = record["repository_name"]
-            record["frdr_origin_icon"] = record["repository_thumbnail"]
-
-            # remove unneeded columns from output
-            record.pop("contact", None)
-            record.pop("deleted", None)
-            record.pop("item_url_pattern", None)
-            record.pop("last_crawl_timestamp", None)
-            record.pop("local_identifier", None)
-            record.pop("modified_timestamp", None)
-            record.pop("pub_date", None)
-            record.pop("record_id", None)
-            record.pop("repository_name", None)
-            record.pop("repository_thumbnail", None)
-            record.pop("repository_url", None)
-            record.pop("series", None)
-            record.pop("title", None)
-            record.pop("title_fr", None)
-
-            # record["@context"] = {
-            #     "dc": "http://dublincore.org/documents/dcmi-terms",
-            #     "frdr": "https://frdr.ca/schema/1.0",
-            #     "datacite": "https://schema.labs.datacite.org/meta/kernel-4.0/metadata.xsd"
-            # }
-            # for custom_schema in domain_schemas:
-            #     short_label = domain_schemas[custom_schema]
-            #     record["@context"].update({short_label: custom_schema})
-            record["datacite_resourceTypeGeneral"] = "dataset"
-            gmeta_data = {"@datatype": "GMetaEntry", "@version": "2016-11-09",
-                          "subject": record["item_url"], "visible_to": ["public"], "mimetype": "application/json",
-                          "content": record}
-            self.output_buffer.append(gmeta_data)
-
-            self.buffer_size = self.buffer_size + len(json.dumps(gmeta_data))
-            records_assembled += 1
-            if (records_assembled % 1000 == 0):
-                self.logger.info("Done processing {} records for export".format(records_assembled))
-
+            for record in records:
+                gmeta_data = self._assemble_gmeta(record, related)
+                if self.export_format == "gmeta":
+                    self._write_gmeta_entry(gmeta_data, export_filepath, temp_filepath, buffer_limit)
+                else:
+                    if self.buffer_size > buffer_limit:
+                        self._write_batch(export_filepath, temp_filepath, start_time)
+                    self.output_buffer.append(gmeta_data)
+                    self.buffer_size = self.buffer_size + len(json.dumps(gmeta_data))
+                records_assembled += 1
+                if (records_assembled % 1000 == 0):
+                    self.logger.info("Done processing {} records for export".format(records_assembled))
+
+        if self.gmeta_basename is not None:
+            self._close_gmeta_file(export_filepath)
         if self.output_buffer:
             self._write_batch(export_filepath, temp_filepath, start_time)
 
         self.logger.info("Export complete: {} items in {} files".format(records_assembled, self.batch_number))
         return deleted
 
+    def _prefetch_related(self, record_ids):
+        """ Fetch related values for a chunk of records with one query per table, grouped by record_id """
+        related = {}
+        in_clause = ",".join("?" for record_id in record_ids)
+        con = self.db.getConnection()
+        with con:
+            if self.db.getType() == "sqlite":
+                con.row_factory = None
+            litecur = con.cursor()
+
+            # TODO update this to export new geospatial elements
+            for field, sql in [("frdr_geospatial", "SELECT record_id, coordinate_type, lat, lon FROM geospatial "
+                                                   "WHERE record_id IN ({}) ORDER BY geospatial_id"),
+                               ("domain_metadata", "SELECT dm.record_id, ds.namespace, dm.field_name, dm.field_value "
+                                                   "FROM domain_metadata dm, domain_schemas ds WHERE dm.schema_id=ds.schema_id "
+                                                   "AND dm.record_id IN ({}) ORDER BY dm.metadata_id")]:
+                related[field] = {}
+                litecur.execute(self.db._prep(sql.format(in_clause)), record_ids)
+                for row in litecur:
+                    related[field].setdefault(row[0], []).append(row[1:])
+
+            for field, sql in self.__related_queries:
+                related[field] = {}
+                litecur.execute(self.db._prep(sql.format(in_clause)), record_ids)
+                for row in litecur:
+                    if row[1]:
+                        related[field].setdefault(row[0], []).append(row[1])
+
+        return related
+
+    def _assemble_gmeta(self, record, related):
+        """ Attach a record's prefetched related values and build its gmeta entry """
+        geodata = related["frdr_geospatial"].get(record["record_id"], [])
+        record["frdr_geospatial"] = []
+        polycoordinates = []
+
+        try:
+            for coordinate in geodata:
+                if coordinate[0] == "Polygon":
+                    polycoordinates.append([float(coordinate[1]), float(coordinate[2])])
+                else:
+                    record["frdr_geospatial"].append({"frdr_geospatial_type": "Feature",
+                                                      "frdr_geospatial_geometry": {
+                                                          "frdr_geometry_type": coordinate[0],
+                                                          "frdr_geometry_coordinates": [float(coordinate[1]),
+                                                                                        float(coordinate[2])]}})
+        except:
+            pass
+
+        if polycoordinates:
+            record["frdr_geospatial"].append({"frdr_geospatial_type": "Feature",
+                                              "frdr_geospatial_geometry": {"frdr_geometry_type": "Polygon",
+                                                                           "frdr_geometry_coordinates": polycoordinates}})
+
+        # attach the other values to the dict
+        for field, query in self.__related_queries:
+            record[field] = related[field].get(record["record_id"], [])
+
+        domain_schemas = {}
+        for row in related["domain_metadata"].get(record["record_id"], []):
+            domain_namespace = str(row[0])
+            if domain_namespace not in domain_schemas.keys():
+                current_count = len(domain_schemas)
+                domain_schemas[domain_namespace] = "frdrcust" + str(current_count + 1)
+            custom_label = domain_schemas[domain_namespace] + ":" + str(row[1])
+            record[custom_label] = str(row[2])
+
+        # Convert friendly column names into dc element names
+        record["dc_title_en"] = record["title"]
+        record["dc_title_fr"] = record["title_fr"]
+        record["dc_date"] = record["pub_date"]
+        record["frdr_series"] = record["series"]
+        record["frdr_origin_id"] = record["repository_name"]
+        record["frdr_origin_icon"] = record["repository_thumbnail"]
+
+        # remove unneeded columns from output
+        record.pop("contact", None)
+        record.pop("deleted", None)
+        record.pop("item_url_pattern", None)
+        record.pop("last_crawl_timestamp", None)
+        record.pop("local_identifier", None)
+        record.pop("modified_timestamp", None)
+        record.pop("pub_date", None)
+        record.pop("record_id", None)
+        record.pop("repository_name", None)
+        record.pop("repository_thumbnail", None)
+        record.pop("repository_url", None)
+        record.pop("series", None)
+        record.pop("title", None)
+        record.pop("title_fr", None)
+
+        # record["@context"] = {
+        #     "dc": "http://dublincore.org/documents/dcmi-terms",
+        #     "frdr": "https://frdr.ca/schema/1.0",
+        #     "datacite": "https://schema.labs.datacite.org/meta/kernel-4.0/metadata.xsd"
+        # }
+        # for custom_schema in domain_schemas:
+        #     short_label = domain_schemas[custom_schema]
+        #     record["@context"].update({short_label: custom_schema})
+        record["datacite_resourceTypeGeneral"] = "dataset"
+        gmeta_data = {"@datatype": "GMetaEntry", "@version": "2016-11-09",
+                      "subject": record["item_url"], "visible_to": ["public"], "mimetype": "application/json",
+                      "content": record}
+        return gmeta_data
+
     def change_keys(self, obj, dropkeys, renamekeys):
         """ Recursively goes through the object and replaces keys """
         if self.db.dbtype == "postgres":
@@ -343,15 +333,57 @@ class Exporter(object):
 
         return xml_tree
 
+    def _open_gmeta_file(self, temp_filepath):
+        try:
+            os.mkdir(temp_filepath)
+        except:
+            pass
+
+        self.gmeta_basename = "gmeta_" + str(self.batch_number) + ".json"
+        self.gmeta_temp_filename = os.path.join(temp_filepath, self.gmeta_basename)
+        try:
+            self.gmeta_file = open(self.gmeta_temp_filename, "w")
+        except:
+            self.logger.error("Unable to write output data to temporary file: {}".format(self.gmeta_temp_filename))
+            self.gmeta_file = None
+        self._write_gmeta(self.__gmeta_header)
+
+    def _write_gmeta(self, output):
+        # Count bytes even if the file could not be written, so batches still roll over at the same points
+        self.buffer_size += len(output)
+        if self.gmeta_file is None:
+            return
+        try:
+            self.gmeta_file.write(output)
+        except:
+            self.logger.error("Unable to write output data to temporary file: {}".format(self.gmeta_temp_filename))
+            self.gmeta_file.close()
+            self.gmeta_file = None
+
+    def _write_gmeta_entry(self, gmeta_data, export_filepath, temp_filepath, buffer_limit):
+        """ Encode one entry straight into the open gmeta file, starting the next file once the size limit is passed """
+        if self.gmeta_basename is not None and self.buffer_size > buffer_limit:
+            self._close_gmeta_file(export_filepath)
+        if self.gmeta_basename is None:
+            self._open_gmeta_file(temp_filepath)
+            self._write_gmeta(json.dumps(gmeta_data))
+        else:
+            self._write_gmeta(", " + json.dumps(gmeta_data))
+
+    def _close_gmeta_file(self, export_filepath):
+        self.logger.debug("Writing batch {} to output file".format(self.batch_number))
+        self._write_gmeta(self.__gmeta_footer)
+        if self.gmeta_file is not None:
+            self.gmeta_file.close()
+            self._move_to_export(self.gmeta_temp_filename, export_filepath, self.gmeta_basename)
+        self.gmeta_file = None
+        self.gmeta_basename = None
+        self.batch_number += 1
+        self.buffer_size = 0
+
     def _write_batch(self, export_filepath, temp_filepath, start_time):
         self.logger.debug("Writing batch {} to output file".format(self.batch_number))
-        if self.export_format == "gmeta":
-            output = json.dumps({"@datatype": "GIngest", "@version": "2016-11-09",
-                                 "ingest_type": "GMetaList",
-                                 "ingest_data": {"@datatype": "GMetaList", "@version": "2016-11-09",
-                                                 "gmeta": self.output_buffer}})
-        elif self.export_format == "xml":
-            output = self._wrap_xml_output(self.output_buffer, start_time)
+        output = self._wrap_xml_output(self.output_buffer, start_time)
         if output:
             self._write_to_file(output, export_filepath, temp_filepath)
         self.output_buffer = []
@@ -365,13 +397,7 @@ class Exporter(object):
             pass
 
         try:
-            if self.export_format == "gmeta":
-                export_basename = "gmeta_" + str(self.batch_number) + ".json"
-                temp_filename = os.path.join(temp_filepath, export_basename)
-                with open(temp_filename, "w") as tempfile:
-                    tempfile.write(output)
-
-            elif self.export_format == "xml":
+            if self.export_format == "xml":
                 export_basename = "export_" + str(self.batch_number) + ".xml"
                 temp_filename = os.path.join(temp_filepath, export_basename)
                 output.write(temp_filename, pretty_print=True, xml_declaration=True, encoding='UTF-8')
@@ -384,6 +410,9 @@ class Exporter(object):
         except:
             self.logger.error("Unable to write output data to temporary file: {}".format(temp_filename))
 
+        self._move_to_export(temp_filename, export_filepath, export_basename)
+
+    def _move_to_export(self, temp_filename, export_filepath, export_basename):
         try:
             os.remove(export_filepath)
         except:
@@ -1,6 +1,7 @@
 import os
 import logging
 import sys
+import copy
 from logging.handlers import RotatingFileHandler
 from harvester.BufferingSMTPHandler import BufferingSMTPHandler
 
@@ -61,6 +62,13 @@ class HarvestLogger:
     def restoreErrorsToEmail(self):
         self.copyerrorstoemail = self.previouserrorstate
 
+    def forRepository(self, copyerrorstoemail):
+        """ Logger sharing this one's handlers, with its own email setting, for a repository and every thread it starts """
+        repo_logger = copy.copy(self)
+        repo_logger.copyerrorstoemail = self.copyerrorstoemail and copyerrorstoemail
+        repo_logger.previouserrorstate = repo_logger.copyerrorstoemail
+        return repo_logger
+
     def debug(self, message):
         self.logger.debug(message)
 
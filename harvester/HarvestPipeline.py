@@ -0,0 +1,101 @@
+import queue
+import threading
+import time
+
+
+class HarvestPipeline(object):
+    """ Run fetch, transform and write stages at the same time, with bounded queues between them """
+
+    _end = object()
+
+    def __init__(self, queue_size=2):
+        self.queue_size = max(1, int(queue_size))
+        self.stopping = threading.Event()
+        self.timings = {"fetch": 0.0, "transform": 0.0, "write": 0.0}
+        self.item_count = 0
+
+    def _put(self, to_queue, item):
+        # Waiting on a full queue is the backpressure; stop waiting if the writer has given up
+        while not self.stopping.is_set():
+            try:
+                to_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, from_queue):
+        while not self.stopping.is_set():
+            try:
+                return from_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return self._end
+
+    def _is_failure(self, item):
+        return isinstance(item, tuple) and len(item) == 2 and item[0] is self._end
+
+    def _fetch_stage(self, fetch, to_queue):
+        try:
+            items = iter(fetch)
+            while not self.stopping.is_set():
+                tstart = time.time()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    self.timings["fetch"] += time.time() - tstart
+                if not self._put(to_queue, item):
+                    return
+            self._put(to_queue, self._end)
+        except Exception as e:
+            self._put(to_queue, (self._end, e))
+
+    def _transform_stage(self, transform, from_queue, to_queue):
+        while True:
+            item = self._get(from_queue)
+            if item is self._end or self._is_failure(item):
+                self._put(to_queue, item)
+                return
+            tstart = time.time()
+            try:
+                result = transform(item)
+            except Exception as e:
+                self._put(to_queue, (self._end, e))
+                return
+            finally:
+                self.timings["transform"] += time.time() - tstart
+            if not self._put(to_queue, result):
+                return
+
+    def run(self, fetch, transform, write):
+        """ Iterate fetch and call transform() on worker threads, and call write() with each result on this thread,
+        which owns the database connection """
+        fetched = queue.Queue(self.queue_size)
+        transformed = queue.Queue(self.queue_size)
+        threads = [threading.Thread(target=self._fetch_stage, args=(fetch, fetched), name="pipeline-fetch"),
+                   threading.Thread(target=self._transform_stage, args=(transform, fetched, transformed),
+                                    name="pipeline-transform")]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                result = transformed.get()
+                if result is self._end:
+                    break
+                if self._is_failure(result):
+                    raise result[1]
+                tstart = time.time()
+                write(result)
+                self.timings["write"] += time.time() - tstart
+                self.item_count += 1
+        finally:
+            self.stopping.set()
+            for thread in threads:
+                thread.join()
+
+    def summary(self):
+        return "fetch {:.1f}s, transform {:.1f}s, write {:.1f}s for {} items".format(
+            self.timings["fetch"], self.timings["transform"], self.timings["write"], self.item_count)
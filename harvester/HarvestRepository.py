@@ -1,6 +1,12 @@
 import time
 import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from harvester.TimeFormatter import TimeFormatter
+from harvester.QueuedDBWriter import QueuedDBWriter
+from harvester.HarvestSession import HarvestSession
+from harvester.HarvestPipeline import HarvestPipeline
 
 import urllib3
 
@@ -20,8 +26,23 @@ class HarvestRepository(object):
             'abort_after_numerrors': 5,
             'max_records_updated_per_run': 100,
             'update_log_after_numitems': 100,
+            'update_workers': 1,
+            'write_batch_size': 100,
+            'bulk_crawl': False,
+            'crawl_workers': 1,
+            'pipeline_queue_size': 100,
+            'http_timeout': 60,
+            'http_pool_connections': 10,
+            'http_pool_maxsize': 10,
+            'http_session': None,
+            'rate_limit': 5,
+            'rate_limit_burst': 5,
+            'rate_limit_max': None,
+            'conditional_get': True,
             'record_refresh_days': 30,
             'repo_refresh_days': 7,
+            'full_harvest_days': 30,
+            'dataverse_name_days': 7,
             'item_url_pattern': None,
             'prune_non_dataset_items': False,
             'enabled': False,
@@ -37,6 +58,7 @@ class HarvestRepository(object):
         for key, value in globalParams.items():
             setattr(self, key, value)
         self.repository_id = 0
+        self.error_lock = threading.Lock()
 
     def setRepoParams(self, repoParams):
         """ Set local repo params and let them override the global config """
@@ -49,6 +71,10 @@ class HarvestRepository(object):
         repo_oai_name = re.sub('[^0-9a-zA-Z\-\.]+', '-', repo_oai_name)
         setattr(self, "repo_oai_name", repo_oai_name)
 
+        if self.http_session is None:
+            self.http_session = HarvestSession(self.http_pool_connections, self.http_pool_maxsize, self.http_timeout,
+                                               self.rate_limit, self.rate_limit_burst, self.rate_limit_max)
+
     def setLogger(self, l):
         self.logger = l
 
@@ -58,11 +84,15 @@ class HarvestRepository(object):
     def setFormatter(self, f):
         self.formatter = f
 
+    def setHTTPSession(self, s):
+        self.http_session = s
+
     def crawl(self):
         self.tstart = time.time()
         if self.repository_id == 0:
             self.repository_id = self.db.get_repo_id(self.url, self.set)
         self.last_crawl = self.db.get_repo_last_crawl(self.repository_id)
+        self.db.lookup_cache.reset_stats()
 
         if self.last_crawl == 0:
             self.logger.info("*** Repo: {}, type: {}, (last harvested: never)".format(self.name, self.type))
@@ -72,7 +102,9 @@ class HarvestRepository(object):
                                                                                            self.tstart - self.last_crawl)))
 
         if (self.enabled):
-            if (self.last_crawl + self.repo_refresh_days * 86400) < self.tstart:
+            # A harvest that was interrupted part way through is picked up again without waiting to be due
+            interrupted = self.db.get_repo_setting(self.repository_id, "crawl_checkpoint") is not None
+            if (self.last_crawl + self.repo_refresh_days * 86400) < self.tstart or interrupted:
                 try:
                     self._crawl()
                     self.db.update_last_crawl(self.repository_id)
@@ -83,6 +115,52 @@ class HarvestRepository(object):
         else:
             self.logger.info("This repo is not enabled for harvesting")
 
+    def _fetch_pages(self, fetch_page, pages):
+        """ Yield fetch_page(page) for each page in order, keeping up to crawl_workers requests in flight """
+        num_workers = max(1, int(self.crawl_workers))
+        if num_workers == 1:
+            for page in pages:
+                yield fetch_page(page)
+            return
+
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for page in pages:
+                in_flight.append(executor.submit(fetch_page, page))
+                if len(in_flight) >= num_workers:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+
+    def _run_pipeline(self, fetch, transform, write):
+        """ Iterate fetch and transform() its items on their own threads while write() runs on this one, then log the time spent in each stage """
+        pipeline = HarvestPipeline(self.pipeline_queue_size)
+        try:
+            pipeline.run(fetch, transform, write)
+        finally:
+            self.logger.info("Pipeline stages: {}".format(pipeline.summary()))
+
+    def _conditional_get(self, record, url, **kwargs):
+        """ GET url, sending the validators saved from its last response; returns None, after touching the record, if the server answers 304 Not Modified """
+        headers = dict(kwargs.pop("headers", None) or {})
+        if self.conditional_get:
+            etag, last_modified = self.db.get_http_validators(url)
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        response = self.http_session.get(url, headers=headers, **kwargs)
+        if response.status_code == 304:
+            self.db.touch_record(record)
+            return None
+        return response
+
+    def _save_validators(self, record, url, response):
+        """ Remember the response's validators for url, once its record has been written """
+        if self.conditional_get and response.status_code == 200:
+            self.db.set_http_validators(record['record_id'], url, response.headers.get("ETag"),
+                                        response.headers.get("Last-Modified"))
+
     def _update_record(self, record):
         """ This method to be overridden """
         return True
@@ -94,32 +172,95 @@ class HarvestRepository(object):
         if self.db == None:
             self.logger.error("Database configuration is not complete")
             return False
-        record_count = 0
         tstart = time.time()
         self.logger.info("Looking for stale records to update")
         stale_timestamp = int(time.time() - self.record_refresh_days * 86400)
 
         records = self.db.get_stale_records(stale_timestamp, self.repository_id, self.max_records_updated_per_run)
-        for record in records:
-            if record_count == 0:
-                self.logger.info("Started processing for {} records".format(len(records)))
+        if len(records) > 0:
+            self.logger.info("Started processing for {} records".format(len(records)))
+
+        record_count = self._update_records(records, tstart)
+
+        self.logger.info("Updated {} items in {} ({:.1f} items/sec)".format(record_count, self.formatter.humanize(
+            time.time() - tstart), record_count / (time.time() - tstart + 0.1)))
+        lookup_cache = self.db.lookup_cache
+        self.logger.info("Lookup cache: {} hits, {} misses, {} entries".format(lookup_cache.hits, lookup_cache.misses,
+                                                                               len(lookup_cache)))
+
+    def _update_records(self, records, tstart):
+        """ Call _update_record() for each record, with update_workers in flight, until one asks to abort """
+        if int(self.update_workers) > 1:
+            return self._update_records_concurrently(records, tstart)
 
+        record_count = 0
+        for record in records:
             status = self._update_record(record)
             if not status:
-                self.logger.error(
-                    "Aborting due to errors after {} items updated in {} ({:.1f} items/sec)".format(
-                        record_count, 
-                        self.formatter.humanize(time.time() - tstart), 
-                        record_count / (time.time() - tstart + 0.1))
-                    )
+                self._log_update_aborted(record_count, tstart)
                 break
 
             record_count = record_count + 1
-            if (record_count % self.update_log_after_numitems == 0):
-                tdelta = time.time() - tstart + 0.1
-                self.logger.info(
-                    "Done {} items after {} ({:.1f} items/sec)".format(record_count, self.formatter.humanize(tdelta),
-                                                                       (record_count / tdelta)))
+            self._log_update_progress(record_count, tstart)
+        return record_count
 
-        self.logger.info("Updated {} items in {} ({:.1f} items/sec)".format(record_count, self.formatter.humanize(
-            time.time() - tstart), record_count / (time.time() - tstart + 0.1)))
+    def _update_records_concurrently(self, records, tstart):
+        """ Keep update_workers calls to _update_record() in flight, running their DB calls on this thread """
+        record_count = 0
+        aborted = False
+        db = self.db
+        writer = QueuedDBWriter(db)
+        self.db = writer
+        try:
+            with ThreadPoolExecutor(max_workers=int(self.update_workers)) as executor:
+                records_iter = iter(records)
+                pending = set()
+                while True:
+                    while not aborted and len(pending) < int(self.update_workers):
+                        record = next(records_iter, None)
+                        if record is None:
+                            break
+                        future = executor.submit(self._update_record, record)
+                        future.add_done_callback(writer.wake)
+                        pending.add(future)
+                    if not pending:
+                        break
+                    writer.serve()
+                    for future in [f for f in pending if f.done()]:
+                        pending.remove(future)
+                        try:
+                            status = future.result()
+                        except Exception as e:
+                            self.logger.error("Updating item failed (repo_id:{}): {}".format(self.repository_id, e))
+                            status = False
+                        if not status:
+                            if not aborted:
+                                self._log_update_aborted(record_count, tstart)
+                            aborted = True
+                            continue
+                        record_count = record_count + 1
+                        self._log_update_progress(record_count, tstart)
+        finally:
+            self.db = db
+        return record_count
+
+    def _count_error(self):
+        """ Count a failed update, returning True if the harvest should carry on; update workers may call this at once """
+        with self.error_lock:
+            self.error_count = self.error_count + 1
+            return self.error_count < self.abort_after_numerrors
+
+    def _log_update_progress(self, record_count, tstart):
+        if (record_count % self.update_log_after_numitems == 0):
+            tdelta = time.time() - tstart + 0.1
+            self.logger.info(
+                "Done {} items after {} ({:.1f} items/sec)".format(record_count, self.formatter.humanize(tdelta),
+                                                                   (record_count / tdelta)))
+
+    def _log_update_aborted(self, record_count, tstart):
+        self.logger.error(
+            "Aborting due to errors after {} items updated in {} ({:.1f} items/sec)".format(
+                record_count,
+                self.formatter.humanize(time.time() - tstart),
+                record_count / (time.time() - tstart + 0.1))
+            )
@@ -0,0 +1,104 @@
+import threading
+import time
+
+from harvester.DBInterface import DBInterface
+from harvester.HostRateLimiter import HostRateLimiter
+from harvester.TimeFormatter import TimeFormatter
+
+
+class HarvestScheduler(object):
+    """ Run crawl() and update_stale_records() for several repositories at once """
+
+    def __init__(self, dbparams, logger, repo_factory, num_workers=1, max_per_host=1):
+        self.dbparams = dbparams
+        self.logger = logger
+        self.repo_factory = repo_factory
+        self.num_workers = max(1, int(num_workers))
+        self.max_per_host = max(1, int(max_per_host))
+        self.formatter = TimeFormatter()
+        self.local = threading.local()
+        self.db_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.pending = []
+        self.active_hosts = {}
+
+    def _get_database(self):
+        # Each worker thread gets its own handle, as connections cannot be shared between threads
+        if getattr(self.local, "db", None) is None:
+            # Opening a handle may apply schema updates, so only one worker does it at a time
+            with self.db_lock:
+                self.local.db = DBInterface(self.dbparams)
+            self.local.db.setLogger(self.logger)
+        return self.local.db
+
+    def _next_repository(self):
+        """ Take the next repo whose host is below the concurrency cap, waiting if every host is busy """
+        with self.condition:
+            while self.pending:
+                for index, repoconfig in enumerate(self.pending):
+                    host = HostRateLimiter.get_host(repoconfig.get("url"))
+                    if self.active_hosts.get(host, 0) < self.max_per_host:
+                        self.pending.pop(index)
+                        self.active_hosts[host] = self.active_hosts.get(host, 0) + 1
+                        return repoconfig, host
+                self.condition.wait()
+        return None, None
+
+    def _release_host(self, host):
+        with self.condition:
+            self.active_hosts[host] = self.active_hosts.get(host, 1) - 1
+            self.condition.notify_all()
+
+    def _harvest_repository(self, repoconfig):
+        repo = self.repo_factory(repoconfig)
+        if repo is None:
+            self.logger.error("Unknown repository type {} for {}".format(repoconfig.get("type"),
+                                                                          repoconfig.get("name")))
+            return
+        # The email override goes with the repository, so errors from its update and pipeline threads follow it too
+        repo_logger = self.logger
+        if 'copyerrorstoemail' in repoconfig and not repoconfig['copyerrorstoemail']:
+            repo_logger = self.logger.forRepository(False)
+        repo.setLogger(repo_logger)
+        db = self._get_database()
+        db.setLogger(repo_logger)
+        try:
+            repo.setRepoParams(repoconfig)
+            repo.setDatabase(db)
+            repo.crawl()
+            repo.update_stale_records(self.dbparams)
+        finally:
+            db.setLogger(self.logger)
+
+    def _worker(self):
+        while True:
+            repoconfig, host = self._next_repository()
+            if repoconfig is None:
+                break
+            try:
+                self._harvest_repository(repoconfig)
+            except Exception as e:
+                self.logger.error("Repository {} unable to be harvested: {}".format(repoconfig.get("name"), e))
+            finally:
+                self._release_host(host)
+
+    def run(self, repo_configs):
+        tstart = time.time()
+        self.pending = list(repo_configs)
+        num_workers = min(self.num_workers, len(self.pending))
+        self.logger.info("Harvesting {} repositories with {} workers (max {} per host)".format(
+            len(self.pending), num_workers, self.max_per_host))
+
+        if num_workers <= 1:
+            # Run in this thread so the harvest behaves exactly as a sequential run
+            self._worker()
+        else:
+            workers = [threading.Thread(target=self._worker, name="harvest-{}".format(i)) for i in
+                       range(num_workers)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        self.logger.info("Harvested {} repositories in {}".format(len(repo_configs),
+                                                                  self.formatter.humanize(time.time() - tstart)))
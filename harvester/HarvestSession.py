@@ -0,0 +1,22 @@
+import requests
+
+from harvester.RateLimitedAdapter import RateLimitedAdapter
+
+
+class HarvestSession(requests.Session):
+    """ Keep-alive HTTP session with pooled, rate limited connections per host and a default timeout, shared by a repository's clients """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, timeout=60, rate_limit=5, rate_limit_burst=5,
+                 rate_limit_max=None):
+        super(HarvestSession, self).__init__()
+        self.timeout = timeout
+        # requests already asks for gzip/deflate and decodes it, so only the pools need configuring
+        self.adapter = RateLimitedAdapter(rate_limit, rate_limit_burst, rate_limit_max,
+                                          pool_connections=int(pool_connections), pool_maxsize=int(pool_maxsize))
+        self.mount("http://", self.adapter)
+        self.mount("https://", self.adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super(HarvestSession, self).request(method, url, **kwargs)
@@ -0,0 +1,100 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class HostRateLimiter(object):
+    """ Token bucket shared by every repository and thread requesting from one host, adapting its rate to the responses """
+
+    limiters = {}
+    limiters_lock = threading.Lock()
+    min_rate = 0.2
+    rate_step = 0.25
+    fast_response_seconds = 0.5
+    recovery_seconds = 30
+    max_retry_after = 300
+
+    def __init__(self, rate=5, burst=5, max_rate=None):
+        self.base_rate, self.burst, self.max_rate = self.get_settings(rate, burst, max_rate)
+        self.rate = self.base_rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.recovered = self.updated
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_host(url):
+        """ Hostname limiters and the scheduler's host cap are kept per; Socrata repos are configured without a scheme """
+        if not url:
+            return ""
+        host = urlparse(url).netloc
+        if host == "":
+            host = url.split("/")[0]
+        return host.lower()
+
+    @classmethod
+    def get_settings(cls, rate, burst, max_rate):
+        """ (rate, burst, max_rate) within their bounds; without a max_rate the rate does not speed up """
+        rate = max(cls.min_rate, float(rate))
+        max_rate = rate if max_rate is None else max(rate, float(max_rate))
+        return rate, max(1.0, float(burst)), max_rate
+
+    @classmethod
+    def for_host(cls, host, rate=5, burst=5, max_rate=None):
+        """ The limiter for host; when repositories on the same host ask for different settings, the strictest apply """
+        with cls.limiters_lock:
+            limiter = cls.limiters.get(host)
+            if limiter is None:
+                limiter = cls.limiters[host] = cls(rate, burst, max_rate)
+            else:
+                limiter.restrict(rate, burst, max_rate)
+            return limiter
+
+    def restrict(self, rate, burst, max_rate=None):
+        """ Lower any setting these are stricter than """
+        rate, burst, max_rate = self.get_settings(rate, burst, max_rate)
+        if rate >= self.base_rate and burst >= self.burst and max_rate >= self.max_rate:
+            return
+        with self.lock:
+            self.base_rate = min(self.base_rate, rate)
+            self.burst = min(self.burst, burst)
+            self.max_rate = min(self.max_rate, max_rate)
+            self.rate = min(self.rate, self.base_rate)
+            self.tokens = min(self.tokens, self.burst)
+
+    def acquire(self):
+        """ Take a token, waiting for one if the bucket is empty; the wait is reserved under the lock but slept outside it """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self._recover(now)
+            self.tokens -= 1
+            wait = self.paused_until - now
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+        if wait > 0:
+            time.sleep(wait)
+
+    def _recover(self, now):
+        """ Double a throttled rate, up to base_rate, for every recovery_seconds since it was last throttled or doubled """
+        if self.rate >= self.base_rate:
+            self.recovered = now
+            return
+        while self.rate < self.base_rate and now - self.recovered >= self.recovery_seconds:
+            self.rate = min(self.base_rate, self.rate * 2)
+            self.recovered += self.recovery_seconds
+
+    def record_response(self, status_code, elapsed, retry_after=None):
+        """ Halve the rate and honour Retry-After when throttled; step it up towards max_rate while responses are fast """
+        with self.lock:
+            if status_code in (429, 503):
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.recovered = time.monotonic()
+                self.tokens = min(self.tokens, 0.0)
+                if retry_after:
+                    self.paused_until = max(self.paused_until,
+                                            time.monotonic() + min(retry_after, self.max_retry_after))
+            elif status_code < 400 and elapsed < self.fast_response_seconds:
+                self.rate = min(self.max_rate, self.rate + self.rate_step)
@@ -0,0 +1,39 @@
+from collections import OrderedDict
+
+
+class LookupCache(object):
+    """ Bounded LRU map of lookup table values (creators, tags, rights hashes...) to their row IDs """
+
+    def __init__(self, maxsize=50000):
+        self.maxsize = max(0, int(maxsize))
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.maxsize == 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
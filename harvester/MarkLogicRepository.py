@@ -1,5 +1,5 @@
 from harvester.HarvestRepository import HarvestRepository
-import requests
+import itertools
 import time
 import json
 import re
@@ -13,7 +13,7 @@ class MarkLogicRepository(HarvestRepository):
         self.metadataprefix = "marklogic"
         super(MarkLogicRepository, self).setRepoParams(repoParams)
         self.domain_metadata = []
-        self.records_per_request = 50
+        self.records_per_request = int(repoParams.get("records_per_request", 50))
         self.params = {
             "format": "json",
             "start": 0,
@@ -42,32 +42,43 @@ class MarkLogicRepository(HarvestRepository):
         self.repository_id = self.db.update_repo(**kwargs)
 
         try:
-            offset = 0
-            while True:
-                self.params["start"] = offset
-                paramstring = "requestURL=" + self.query + "%26" + "%26".join(
-                    "{}%3D{}".format(k, v) for (k, v) in self.params.items())
-                response = requests.get(self.url, params=paramstring,
-                                        verify=False)  # Needs to be string not dict to force specific urlencoding
-                records = response.json()
-                if not records["results"]:
-                    break
-                for record in records["results"]:
-                    oai_record = self.format_marklogic_to_oai(record)
-                    if oai_record:
-                        self.db.write_record(oai_record, self)
-                offset += self.records_per_request
+            first_page = self._search_page(0)
+            if "total" in first_page:
+                offsets = range(self.records_per_request, int(first_page["total"]), self.records_per_request)
+            else:
+                # Without a total, keep requesting pages until one comes back empty
+                offsets = itertools.count(self.records_per_request, self.records_per_request)
+            # Later pages are fetched by crawl_workers threads, and mapped on another, while this one writes the earlier ones
+            pages = itertools.takewhile(lambda records: records["results"],
+                                        itertools.chain([first_page], self._fetch_pages(self._search_page, offsets)))
+            self._run_pipeline(pages, self._format_page, lambda batch: self.db.write_records(batch, self))
 
             return True
 
         except Exception as e:
             self.logger.error("Updating MarkLogic Repository failed: {}".format(e))
-            self.error_count = self.error_count + 1
-            if self.error_count < self.abort_after_numerrors:
+            if self._count_error():
                 return True
 
         return False
 
+    def _search_page(self, offset):
+        params = dict(self.params)
+        params["start"] = offset
+        paramstring = "requestURL=" + self.query + "%26" + "%26".join(
+            "{}%3D{}".format(k, v) for (k, v) in params.items())
+        response = self.http_session.get(self.url, params=paramstring,
+                                         verify=False)  # Needs to be string not dict to force specific urlencoding
+        return response.json()
+
+    def _format_page(self, records):
+        batch = []
+        for record in records["results"]:
+            oai_record = self.format_marklogic_to_oai(record)
+            if oai_record:
+                batch.append(oai_record)
+        return batch
+
     def format_marklogic_to_oai(self, marklogic_record):
         record = {}
         record["creator"] = []
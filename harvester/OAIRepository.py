@@ -1,13 +1,14 @@
 from harvester.HarvestRepository import HarvestRepository
-from harvester.rate_limited import rate_limited
+from harvester.DateNormalizer import DateNormalizer
 from sickle import Sickle
 from sickle.iterator import BaseOAIIterator, OAIItemIterator, OAIResponseIterator
 from sickle.models import OAIItem, Record, Header
 from sickle.oaiexceptions import BadArgument, CannotDisseminateFormat, IdDoesNotExist, NoSetHierarchy, \
     BadResumptionToken, NoRecordsMatch, OAIError
 from collections import defaultdict
+from lxml import etree
 import re
-import dateparser
+import requests
 import os.path
 import time
 import json
@@ -20,38 +21,62 @@ import pdb
 class FRDRRecord(OAIItem):
     """ Override Sickle OAIItem to handle stripping only known namespaces """
 
-    def __init__(self, record_element, strip_ns=False):
+    namespaces_to_strip = frozenset([
+        'http://purl.org/dc/elements/1.1/',
+        'https://schema.datacite.org/meta/kernel-3/',
+        'http://www.openarchives.org/OAI/2.0/'
+    ])
+    # Prefixes usable in a repository's metadata_xpath
+    xpath_namespaces = {
+        'oai_dc': 'http://www.openarchives.org/OAI/2.0/oai_dc/',
+        'dc': 'http://purl.org/dc/elements/1.1/',
+        'datacite': 'http://datacite.org/schema/kernel-4'
+    }
+    all_elements = etree.XPath('descendant::*')
+    # oai_dc elements are all children of the oai_dc:dc root, so there is no need to walk further down. Other prefixes
+    # (ddi, fgdc, frdr) keep every descendant, as their mappings and domain metadata read nested and namespaced fields
+    prefix_paths = {
+        'oai_dc': [etree.XPath('*')]
+    }
+    # Dict key for each element tag seen so far, eg. {http://purl.org/dc/elements/1.1/}title -> title
+    tag_keys = {}
+
+    def __init__(self, record_element, strip_ns=False, paths=None):
         super(FRDRRecord, self).__init__(record_element, strip_ns=strip_ns)
         self.header = Header(self.xml.find('.//' + self._oai_namespace + 'header'))
         self.deleted = self.header.deleted
         if not self.deleted:
-            self.metadata = self.xml_to_dict(self.xml.find('.//' + self._oai_namespace + 'metadata').getchildren()[0])
+            self.metadata = self.xml_to_dict(self.xml.find('.//' + self._oai_namespace + 'metadata').getchildren()[0],
+                                             paths)
+
+    @classmethod
+    def tag_key(cls, tag):
+        key = cls.tag_keys.get(tag)
+        if key is None:
+            qname = etree.QName(tag)
+            if qname.namespace is None or qname.namespace in cls.namespaces_to_strip:
+                key = qname.localname
+            else:
+                key = qname.namespace + "#" + qname.localname
+            cls.tag_keys[tag] = key
+        return key
 
     def xml_to_dict(self, tree, paths=None):
-        """ Modified from Sickle.utils to strip only some namespaces """
-        namespaces_to_strip = [
-            'http://purl.org/dc/elements/1.1/',
-            'https://schema.datacite.org/meta/kernel-3/',
-            'http://www.openarchives.org/OAI/2.0/'
-        ]
-        paths = paths or ['.//']
+        """ Modified from Sickle.utils to strip only some namespaces; paths are compiled XPaths or findall() paths """
+        paths = paths or [self.all_elements]
         fields = defaultdict(list)
         for path in paths:
-            elements = tree.findall(path, {})
+            elements = path(tree) if callable(path) else tree.findall(path, {})
             for element in elements:
-                tag_namespace = re.search('\{(.*)\}', element.tag).group(1)
-                if tag_namespace in namespaces_to_strip:
-                    tag = re.sub(r'\{.*\}', '', element.tag)
-                else:
-                    tag = tag_namespace + "#" + re.sub(r'\{.*\}', '', element.tag)
-                fields[tag].append(element.text)
+                if isinstance(element.tag, str):
+                    fields[self.tag_key(element.tag)].append(element.text)
         return dict(fields)
 
 
 class FRDRItemIterator(BaseOAIIterator):
     """ Modifed from Sickle.interator.OAIItemIterator to implement custom item mapping """
 
-    def __init__(self, sickle, params, ignore_deleted=False):
+    def __init__(self, sickle, params, ignore_deleted=False, metadata_prefix=None):
         VERBS_ELEMENTS = {
             'GetRecord': 'record',
             'ListRecords': 'record',
@@ -62,46 +87,123 @@ class FRDRItemIterator(BaseOAIIterator):
         }
         self.mapper = FRDRRecord
         self.element = VERBS_ELEMENTS[params.get('verb')]
+        self.response_date = None
+        self.pages = 0
+        self.paths = getattr(sickle, "metadata_paths", None) or FRDRRecord.prefix_paths.get(
+            (metadata_prefix or params.get('metadataPrefix') or "").lower())
+        # Called with the next resumption token once every item of the current page has been returned
+        self.page_complete = None
         super(FRDRItemIterator, self).__init__(sickle, params, ignore_deleted)
 
     def _next_response(self):
         super(FRDRItemIterator, self)._next_response()
+        if self.response_date is None:
+            # Date of the first response, which is where the next incremental harvest should start
+            response_date = self.oai_response.xml.find('.//' + self.sickle.oai_namespace + 'responseDate')
+            if response_date is not None:
+                self.response_date = response_date.text
+        self.pages += 1
         self._items = self.oai_response.xml.iterfind('.//' + self.sickle.oai_namespace + self.element)
 
     def next(self):
         """Return the next record/header/set."""
         while True:
             for item in self._items:
-                mapped = self.mapper(item)
+                mapped = self.mapper(item, paths=self.paths)
                 if self.ignore_deleted and mapped.deleted:
                     continue
                 return mapped
             if self.resumption_token and self.resumption_token.token:
+                if self.page_complete is not None:
+                    self.page_complete(self.resumption_token.token)
                 self._next_response()
             else:
                 raise StopIteration
 
 
+class FRDRSickle(Sickle):
+    """ Sickle client that sends its requests through the repository's shared HTTP session """
+
+    def __init__(self, endpoint, http_session, metadata_paths=None, **kwargs):
+        self.http_session = http_session
+        self.metadata_paths = metadata_paths
+        super(FRDRSickle, self).__init__(endpoint, **kwargs)
+
+    def ListRecords(self, ignore_deleted=False, metadata_prefix=None, **kwargs):
+        """ metadata_prefix gives the format of a resumed harvest, as it cannot be sent along with a resumptionToken """
+        params = kwargs
+        params.update({'verb': 'ListRecords'})
+        return self.iterator(self, params, ignore_deleted=ignore_deleted,
+                             metadata_prefix=metadata_prefix or params.get('metadataPrefix'))
+
+    def _request(self, kwargs):
+        if self.http_method == 'GET':
+            return self.http_session.get(self.endpoint, params=kwargs, **self.request_args)
+        return self.http_session.post(self.endpoint, data=kwargs, **self.request_args)
+
+
 class OAIRepository(HarvestRepository):
     """ OAI Repository """
 
     def setRepoParams(self, repoParams):
         self.metadataprefix = "oai_dc"
         self.default_language = "en"
+        self.domain_metadata = []
+        self.metadata_xpath = None
         super(OAIRepository, self).setRepoParams(repoParams)
-        self.sickle = Sickle(self.url, iterator=FRDRItemIterator)
-
-    def _crawl(self):
-        records = []
+        metadata_paths = None
+        if self.metadata_xpath:
+            metadata_paths = [etree.XPath(self.metadata_xpath, namespaces=FRDRRecord.xpath_namespaces)]
+        self.sickle = FRDRSickle(self.url, self.http_session, metadata_paths=metadata_paths, iterator=FRDRItemIterator)
+
+    def _list_records(self, harvest_from=None):
+        # Incremental harvests need deleted records, as the unchanged records they skip are marked as checked
+        kwargs = {"metadataPrefix": self.metadataprefix, "ignore_deleted": harvest_from is None}
+        if self.set is not None and self.set != "":
+            kwargs["set"] = self.set
+        if harvest_from is not None:
+            kwargs["from"] = harvest_from
+        return self.sickle.ListRecords(**kwargs)
+
+    def _harvest_scope(self):
+        return "{}|{}".format(self.metadataprefix, self.set or "")
+
+    def _get_harvest_from(self):
+        """ Datestamp to send as from= for an incremental harvest, or None if a full harvest is due """
+        if int(self.full_harvest_days) <= 0:
+            return None
+        last_response_date = self.db.get_repo_setting(self.repository_id, "oai_last_response_date")
+        last_full_harvest = float(self.db.get_repo_setting(self.repository_id, "oai_last_full_harvest", 0))
+        if last_response_date is None or last_full_harvest + int(self.full_harvest_days) * 86400 < self.tstart:
+            return None
+        if self.db.get_repo_setting(self.repository_id, "oai_harvest_scope") != self._harvest_scope():
+            # The set or metadata format changed, so earlier datestamps do not apply
+            return None
 
+        granularity = "YYYY-MM-DD"
         try:
-            if self.set is None or self.set == "":
-                records = self.sickle.ListRecords(metadataPrefix=self.metadataprefix, ignore_deleted=True)
-            else:
-                records = self.sickle.ListRecords(metadataPrefix=self.metadataprefix, ignore_deleted=True, set=self.set)
-        except:
-            self.logger.info("No items were found")
+            granularity = self.sickle.Identify().granularity
+        except Exception as e:
+            self.logger.debug("Unable to read granularity from Identify, using days: {}".format(e))
+        if granularity.startswith("YYYY-MM-DDThh:mm:ss"):
+            return last_response_date
+        return last_response_date[:10]
+
+    def _get_checkpoint(self):
+        """ Position saved by an interrupted harvest of this set and metadata format, if any """
+        checkpoint = self.db.get_repo_setting(self.repository_id, "crawl_checkpoint")
+        if checkpoint is None:
+            return None
+        try:
+            checkpoint = json.loads(checkpoint)
+        except ValueError:
+            checkpoint = {}
+        if checkpoint.get("scope") != self._harvest_scope():
+            self.db.delete_repo_setting(self.repository_id, "crawl_checkpoint")
+            return None
+        return checkpoint
 
+    def _crawl(self):
         kwargs = {
             "repo_id": self.repository_id, "repo_url": self.url, "repo_set": self.set, "repo_name": self.name,
             "repo_type": "oai",
@@ -114,53 +216,164 @@ class OAIRepository(HarvestRepository):
             "repo_oai_name": self.repo_oai_name
         }
         self.repository_id = self.db.update_repo(**kwargs)
-        item_count = 0
 
-        while records:
+        records = None
+        checkpoint = self._get_checkpoint()
+        if checkpoint is not None:
+            harvest_from = checkpoint["from"]
+            self.logger.info("Resuming interrupted harvest after {} pages and {} items".format(checkpoint["pages"],
+                                                                                              checkpoint["items"]))
             try:
-                record = records.next()
-                metadata = record.metadata
-
-                # Search for a hyperlink in the list of identifiers
-                if 'identifier' in metadata.keys():
-                    if not isinstance(metadata['identifier'], list):
-                        metadata['identifier'] = [metadata['identifier']]
-                    for idt in metadata['identifier']:
-                        # TODO - what about multiple identifiers? We should have some priority here, so we always pick the same one regardless of ordering
-                        if idt.lower().startswith("http"):
-                            metadata['dc:source'] = idt
-                        if idt.lower().startswith("doi:"):
-                            metadata['dc:source'] = "https://doi.org/" + idt[4:]
-                        if idt.lower().startswith("hdl:"):
-                            metadata['dc:source'] = "https://hdl.handle.net/" + idt[4:]
-
-                # EPrints workaround for using header datestamp in lieu of date
-                if 'date' not in metadata.keys() and record.header.datestamp:
-                    metadata["date"] = record.header.datestamp
-
-                # Use the header id for the database key (needed later for OAI GetRecord calls)
-                metadata['identifier'] = record.header.identifier
-                oai_record = self.unpack_oai_metadata(metadata)
-                self.domain_metadata = self.find_domain_metadata(metadata)
-                self.db.write_record(oai_record, self)
-                item_count = item_count + 1
-                if (item_count % self.update_log_after_numitems == 0):
-                    tdelta = time.time() - self.tstart + 0.1
-                    self.logger.info(
-                        "Done {} items after {} ({:.1f} items/sec)".format(item_count, self.formatter.humanize(tdelta),
-                                                                           (item_count / tdelta)))
-
+                records = self.sickle.ListRecords(resumptionToken=checkpoint["token"],
+                                                  ignore_deleted=checkpoint["from"] is None,
+                                                  metadata_prefix=checkpoint.get("metadata_prefix",
+                                                                                 self.metadataprefix))
+            except (BadResumptionToken, BadArgument, OAIError, requests.RequestException) as e:
+                # Endpoints report an expired token as badResumptionToken, badArgument or an HTTP error
+                self.logger.info("Unable to resume harvest, starting again: {}".format(e))
+                checkpoint = None
+                self.db.delete_repo_setting(self.repository_id, "crawl_checkpoint")
+
+        if checkpoint is None:
+            harvest_from = self._get_harvest_from()
+        if records is None and harvest_from is not None:
+            self.logger.info("Harvesting items changed since {}".format(harvest_from))
+            try:
+                records = self._list_records(harvest_from)
+            except NoRecordsMatch:
+                self.logger.info("No items have changed since {}".format(harvest_from))
+                records = []
+            except BadArgument as e:
+                self.logger.info("Repository rejected from={}, doing a full harvest instead: {}".format(harvest_from, e))
+                harvest_from = None
+        if records is None:
+            try:
+                records = self._list_records()
+            except:
+                self.logger.info("No items were found")
+                records = []
+
+        progress = {"items": 0, "pages": 0}
+        response_date = getattr(records, "response_date", None)
+        if checkpoint is not None:
+            progress["items"] = checkpoint["items"]
+            progress["pages"] = checkpoint["pages"]
+            response_date = checkpoint["response_date"]
+        first_pages = progress["pages"]
+        batch = []
+
+        def fetch():
+            """ Yield records, and a checkpoint wherever a page ends, as they are fetched """
+            finished_pages = []
+            if records:
+                records.page_complete = lambda token: finished_pages.append((token, records.pages))
+            while records:
+                try:
+                    record = records.next()
+                except AttributeError:
+                    # probably not a valid OAI record
+                    # Islandora throws this for non-object directories
+                    self.logger.debug("AttributeError while fetching an item")
+                    continue
+                except StopIteration:
+                    break
+                finally:
+                    # A page is finished as soon as the next one is requested, even if that request fails
+                    while finished_pages:
+                        yield ("checkpoint", finished_pages.pop(0))
+                yield ("record", record)
+
+        def transform(item):
+            kind, record = item
+            if kind != "record":
+                return item
+            if record.deleted:
+                return ("deleted", record.header.identifier)
+            try:
+                return ("record", self.map_oai_record(record))
             except AttributeError:
-                # probably not a valid OAI record
-                # Islandora throws this for non-object directories
-                self.logger.debug("AttributeError while working on item {}".format(item_count))
-                pass
-
-            except StopIteration:
-                break
-
+                self.logger.debug("AttributeError while working on item {}".format(record.header.identifier))
+                return ("skip", None)
+
+        def write(item):
+            kind, value = item
+            if kind == "checkpoint":
+                # Write out everything from the finished page before recording where to carry on from
+                token, pages = value
+                self.db.write_records(batch, self)
+                del batch[:]
+                self.db.set_repo_setting(self.repository_id, "crawl_checkpoint", json.dumps({
+                    "token": token, "pages": first_pages + pages, "items": progress["items"], "from": harvest_from,
+                    "response_date": response_date, "metadata_prefix": self.metadataprefix,
+                    "scope": self._harvest_scope()}))
+                return
+            if kind == "deleted":
+                for existing in self.db.get_multiple_records("records", "record_id, local_identifier", "repository_id",
+                                                             self.repository_id, "and deleted=0", local_identifier=value):
+                    self.db.delete_record(existing)
+                return
+            if kind != "record":
+                return
+            if value is not None:
+                batch.append(value)
+            if len(batch) >= int(self.write_batch_size):
+                self.db.write_records(batch, self)
+                del batch[:]
+            progress["items"] = progress["items"] + 1
+            if (progress["items"] % self.update_log_after_numitems == 0):
+                tdelta = time.time() - self.tstart + 0.1
+                self.logger.info(
+                    "Done {} items after {} ({:.1f} items/sec)".format(progress["items"], self.formatter.humanize(tdelta),
+                                                                       (progress["items"] / tdelta)))
+
+        self._run_pipeline(fetch(), transform, write)
+        item_count = progress["items"]
+
+        self.db.write_records(batch, self)
+        self.db.delete_repo_setting(self.repository_id, "crawl_checkpoint")
         self.logger.info("Processed {} items in feed".format(item_count))
 
+        if harvest_from is not None:
+            # Records an incremental harvest did not return are unchanged, so they do not need refreshing either
+            covered = self.db.get_multiple_records("records", "record_id", "repository_id", self.repository_id,
+                                                   "and deleted=0 and modified_timestamp>0")
+            self.db.touch_records([record["record_id"] for record in covered])
+
+        if response_date:
+            self.db.set_repo_setting(self.repository_id, "oai_last_response_date", response_date)
+            self.db.set_repo_setting(self.repository_id, "oai_harvest_scope", self._harvest_scope())
+            if harvest_from is None:
+                self.db.set_repo_setting(self.repository_id, "oai_last_full_harvest", int(self.tstart))
+
+    def map_oai_record(self, record):
+        """ Turn a harvested FRDRRecord into the record dict write_records() expects, or None to skip it """
+        metadata = record.metadata
+
+        # Search for a hyperlink in the list of identifiers
+        if 'identifier' in metadata.keys():
+            if not isinstance(metadata['identifier'], list):
+                metadata['identifier'] = [metadata['identifier']]
+            for idt in metadata['identifier']:
+                # TODO - what about multiple identifiers? We should have some priority here, so we always pick the same one regardless of ordering
+                if idt.lower().startswith("http"):
+                    metadata['dc:source'] = idt
+                if idt.lower().startswith("doi:"):
+                    metadata['dc:source'] = "https://doi.org/" + idt[4:]
+                if idt.lower().startswith("hdl:"):
+                    metadata['dc:source'] = "https://hdl.handle.net/" + idt[4:]
+
+        # EPrints workaround for using header datestamp in lieu of date
+        if 'date' not in metadata.keys() and record.header.datestamp:
+            metadata["date"] = record.header.datestamp
+
+        # Use the header id for the database key (needed later for OAI GetRecord calls)
+        metadata['identifier'] = record.header.identifier
+        oai_record = self.unpack_oai_metadata(metadata)
+        domain_metadata = self.find_domain_metadata(metadata)
+        if oai_record is not None:
+            oai_record["domain_metadata"] = domain_metadata
+        return oai_record
+
     def unpack_oai_metadata(self, record):
         record["pub_date"] = record.get("date")
 
@@ -273,14 +486,14 @@ class OAIRepository(HarvestRepository):
             return None
 
         try:
-            date_object = dateparser.parse(record["pub_date"])
-            if date_object is None:
-                date_object = dateparser.parse(record["pub_date"], date_formats=['%Y%m%d'])
-            record["pub_date"] = date_object.strftime("%Y-%m-%d")
+            pub_date = DateNormalizer.normalize(record["pub_date"])
         except:
+            pub_date = None
+        if pub_date is None:
             self.logger.debug("Something went wrong parsing the date, {} from {}", record["pub_date"]
                               , (record["dc:source"] if record["identifier"] is None else record["identifier"]))
             return None
+        record["pub_date"] = pub_date
 
 
         if "title" not in record.keys():
@@ -365,7 +578,6 @@ class OAIRepository(HarvestRepository):
                     newRecord[elementName] = record.pop(elementName, None)
         return newRecord
 
-    @rate_limited(5)
     def _update_record(self, record):
         #self.logger.debug("Updating OAI record {}".format(record['local_identifier']))
 
@@ -387,10 +599,11 @@ class OAIRepository(HarvestRepository):
 
             metadata['identifier'] = single_record.header.identifier
             oai_record = self.unpack_oai_metadata(metadata)
-            self.domain_metadata = self.find_domain_metadata(metadata)
+            domain_metadata = self.find_domain_metadata(metadata)
             if oai_record is None:
                 self.db.delete_record(record)
                 return False
+            oai_record["domain_metadata"] = domain_metadata
             self.db.write_record(oai_record, self)
             return True
 
@@ -409,8 +622,7 @@ class OAIRepository(HarvestRepository):
                     pass
             # Touch the record so we do not keep requesting it on every run
             self.db.touch_record(record)
-            self.error_count = self.error_count + 1
-            if self.error_count < self.abort_after_numerrors:
+            if self._count_error():
                 return True
 
         return False
@@ -1,20 +1,23 @@
 from harvester.HarvestRepository import HarvestRepository
-import requests
+from harvester.DateNormalizer import DateNormalizer
+import itertools
 import time
 import json
 import re
 import os.path
-from dateutil import parser
 
 
 class OpenDataSoftRepository(HarvestRepository):
     """ OpenDataSoft Repository """
 
+    modified_margin = 3600
+
     def setRepoParams(self, repoParams):
         self.metadataprefix = "opendatasoft"
         super(OpenDataSoftRepository, self).setRepoParams(repoParams)
         self.domain_metadata = []
-        self.records_per_request = 50
+        # Mapping whole search pages is cheap, so bulk crawls default to much larger ones
+        self.records_per_request = int(repoParams.get("records_per_request", 1000 if self.bulk_crawl else 50))
         self.params = {
             "start": 0,
             "pageLength": self.records_per_request
@@ -41,14 +44,18 @@ class OpenDataSoftRepository(HarvestRepository):
         }
         self.repository_id = self.db.update_repo(**kwargs)
 
+        if self.bulk_crawl:
+            self._bulk_crawl()
+            return True
+
         try:
             offset = 0
             item_count = 0
             while True:
                 self.params["start"] = offset
                 payload = {"rows": self.records_per_request, "start": self.params["start"]}
-                response = requests.get(self.url, params=payload,
-                                        verify=False)  # Needs to be string not dict to force specific urlencoding
+                response = self.http_session.get(self.url, params=payload,
+                                                 verify=False)  # Needs to be string not dict to force specific urlencoding
                 records = response.json()
                 if not records["datasets"]:
                     break
@@ -67,16 +74,80 @@ class OpenDataSoftRepository(HarvestRepository):
 
         except Exception as e:
             self.logger.error("Updating OpenDataSoft Repository failed: {}".format(e))
-            self.error_count = self.error_count + 1
-            if self.error_count < self.abort_after_numerrors:
+            if self._count_error():
                 return True
 
         return False
 
+    def _search_datasets(self, start, modified_since=None):
+        payload = {"rows": self.records_per_request, "start": start}
+        if modified_since is not None:
+            payload["q"] = "modified>={}".format(time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(modified_since)))
+        response = self.http_session.get(self.url, params=payload, verify=False)
+        response.raise_for_status()
+        return response.json()
+
+    def _get_modified_since(self):
+        """ Time to search for changed datasets from, or None if a full harvest is due """
+        if int(self.full_harvest_days) <= 0:
+            return None
+        modified_since = self.db.get_repo_setting(self.repository_id, "opendatasoft_modified_since")
+        last_full_harvest = float(self.db.get_repo_setting(self.repository_id, "opendatasoft_last_full_harvest", 0))
+        if modified_since is None or last_full_harvest + int(self.full_harvest_days) * 86400 < self.tstart:
+            return None
+        # Allow for clock differences and for datasets indexed while the last crawl was running
+        return float(modified_since) - self.modified_margin
+
+    def _bulk_crawl(self):
+        """ Write full records from search pages, rather than headers to be fetched one by one later """
+        modified_since = self._get_modified_since()
+        first_page = self._search_datasets(0, modified_since)
+        # The portal may return fewer rows per page than asked for
+        page_size = len(first_page["datasets"]) or self.records_per_request
+        pages = itertools.chain([first_page], self._fetch_pages(lambda start: self._search_datasets(start, modified_since),
+                                                                range(page_size, int(first_page["nhits"]), page_size)))
+        if modified_since is None:
+            self.logger.info("Found {} items in feed".format(first_page["nhits"]))
+        else:
+            self.logger.info("Found {} items changed since {}".format(first_page["nhits"],
+                                                                      time.strftime("%Y-%m-%d %H:%M:%S UTC",
+                                                                                    time.gmtime(modified_since))))
+
+        item_count = 0
+        batch = []
+        for page in pages:
+            for opendatasoft_record in page["datasets"]:
+                try:
+                    oai_record = self.format_opendatasoft_to_oai(opendatasoft_record)
+                except Exception as e:
+                    self.logger.error("Unable to map record {}, leaving it to be updated later: {}".format(
+                        opendatasoft_record["datasetid"], e))
+                    oai_record = None
+                if oai_record:
+                    batch.append(oai_record)
+                else:
+                    self.db.write_header(opendatasoft_record["datasetid"], self.repository_id)
+                if len(batch) >= int(self.write_batch_size):
+                    self.db.write_records(batch, self)
+                    batch = []
+                item_count = item_count + 1
+                if (item_count % self.update_log_after_numitems == 0):
+                    tdelta = time.time() - self.tstart + 0.1
+                    self.logger.info("Done {} items after {} ({:.1f} items/sec)".format(item_count,
+                                                                                        self.formatter.humanize(tdelta),
+                                                                                        item_count / tdelta))
+
+        self.db.write_records(batch, self)
+        self.logger.info("Processed {} items in feed".format(item_count))
+
+        self.db.set_repo_setting(self.repository_id, "opendatasoft_modified_since", int(self.tstart))
+        if modified_since is None:
+            self.db.set_repo_setting(self.repository_id, "opendatasoft_last_full_harvest", int(self.tstart))
+
     def format_opendatasoft_to_oai(self, opendatasoft_record):
         record = {}
         record["identifier"] = opendatasoft_record["datasetid"]
-        record["pub_date"] = parser.parse(opendatasoft_record["metas"]["modified"]).strftime('%Y-%m-%d')
+        record["pub_date"] = DateNormalizer.parse(opendatasoft_record["metas"]["modified"]).strftime('%Y-%m-%d')
         record["title"] = opendatasoft_record["metas"]["title"]
         record["description"] = opendatasoft_record["metas"].get("description", "")
         record["publisher"] = opendatasoft_record["metas"].get("publisher", "")
@@ -119,7 +190,10 @@ class OpenDataSoftRepository(HarvestRepository):
         try:
             record_url = self.url.replace("search", "") + record['local_identifier']
             try:
-                item_response = requests.get(record_url)
+                item_response = self._conditional_get(record, record_url)
+                if item_response is None:
+                    # Unchanged since it was last fetched
+                    return True
                 opendatasoft_record = json.loads(item_response.text)
             except:
                 # Exception means this URL was not found
@@ -128,6 +202,7 @@ class OpenDataSoftRepository(HarvestRepository):
             oai_record = self.format_opendatasoft_to_oai(opendatasoft_record)
             if oai_record:
                 self.db.write_record(oai_record, self)
+                self._save_validators(record, record_url, item_response)
             return True
         except Exception as e:
             self.logger.error("Updating record {} failed: {}".format(record['local_identifier'], e))
@@ -138,8 +213,7 @@ class OpenDataSoftRepository(HarvestRepository):
                     pass
             # Touch the record so we do not keep requesting it on every run
             self.db.touch_record(record)
-            self.error_count = self.error_count + 1
-            if self.error_count < self.abort_after_numerrors:
+            if self._count_error():
                 return True
 
         return False
@@ -0,0 +1,44 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class QueuedDBWriter(object):
+    """ Stand-in for DBInterface that runs calls from worker threads on the thread owning the connection """
+
+    def __init__(self, db):
+        self.db = db
+        self.owner = threading.get_ident()
+        self.calls = queue.Queue()
+
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+
+        def queued_call(*args, **kwargs):
+            if threading.get_ident() == self.owner:
+                return attr(*args, **kwargs)
+            future = Future()
+            self.calls.put((future, attr, args, kwargs))
+            return future.result()
+
+        return queued_call
+
+    def wake(self, *args):
+        """ Interrupt serve(), eg. when a worker has finished; usable as a Future done callback """
+        self.calls.put(None)
+
+    def serve(self):
+        """ Run queued database calls, in order, until woken """
+        while True:
+            item = self.calls.get()
+            if item is None:
+                return
+            future, method, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(method(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
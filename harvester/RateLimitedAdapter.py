@@ -0,0 +1,46 @@
+import time
+from email.utils import parsedate_to_datetime
+
+from requests.adapters import HTTPAdapter
+
+from harvester.HostRateLimiter import HostRateLimiter
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """ Connection pool adapter that waits on the per-host rate limiter, and retries requests the server throttled """
+
+    def __init__(self, rate=5, burst=5, max_rate=None, throttle_retries=2, **kwargs):
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max_rate
+        self.throttle_retries = throttle_retries
+        super(RateLimitedAdapter, self).__init__(**kwargs)
+
+    @staticmethod
+    def get_retry_after(response):
+        """ Retry-After in seconds, given either as a number of seconds or as an HTTP date """
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except:
+            return None
+
+    def send(self, request, **kwargs):
+        limiter = HostRateLimiter.for_host(HostRateLimiter.get_host(request.url), self.rate, self.burst, self.max_rate)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            tstart = time.monotonic()
+            response = super(RateLimitedAdapter, self).send(request, **kwargs)
+            limiter.record_response(response.status_code, time.monotonic() - tstart,
+                                    self.get_retry_after(response))
+            if response.status_code not in (429, 503) or attempt >= self.throttle_retries:
+                return response
+            attempt += 1
+            response.close()
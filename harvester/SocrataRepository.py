@@ -1,7 +1,8 @@
 from harvester.HarvestRepository import HarvestRepository
-from harvester.rate_limited import rate_limited
+from harvester.DateNormalizer import DateNormalizer
 from sodapy import Socrata
 from datetime import datetime
+import itertools
 import time
 import json
 import re
@@ -11,12 +12,16 @@ import os.path
 class SocrataRepository(HarvestRepository):
     """ Socrata Repository """
 
+    search_rows = 1000
+
     def setRepoParams(self, repoParams):
         self.metadataprefix = "socrata"
         super(SocrataRepository, self).setRepoParams(repoParams)
         # sodapy doesn't like http/https preceding URLs
-        self.socratarepo = Socrata(self.url, self.socrata_app_token)
+        self.socratarepo = Socrata(self.url, self.socrata_app_token, timeout=self.http_timeout,
+                                  session_adapter={"prefix": "https://", "adapter": self.http_session.adapter})
         self.domain_metadata = []
+        self.licenses = {}
 
 
     def _crawl(self):
@@ -29,6 +34,11 @@ class SocrataRepository(HarvestRepository):
             "repo_oai_name": self.repo_oai_name
         }
         self.repository_id = self.db.update_repo(**kwargs)
+
+        if self.bulk_crawl:
+            self._bulk_crawl()
+            return
+
         records = self.socratarepo.datasets()
 
         item_count = 0
@@ -41,6 +51,85 @@ class SocrataRepository(HarvestRepository):
 
         self.logger.info("Found {} items in feed".format(item_count) )
 
+    def _catalog_page(self, offset):
+        """ One page of the catalog; sodapy's datasets() cannot return a short final page """
+        # sodapy's session carries the app token and is mounted on the shared adapter
+        response = self.socratarepo.session.get("https://{}/api/catalog/v1".format(self.url),
+                                                params={"domains": self.url, "limit": self.search_rows,
+                                                        "offset": offset},
+                                                timeout=self.http_timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def catalog_to_metadata(self, catalog_record):
+        """ Rebuild the get_metadata() fields format_socrata_to_oai uses from a catalog entry """
+        resource = catalog_record["resource"]
+        classification = catalog_record.get("classification", {})
+        socrata_record = {
+            "name": resource.get("name") or "",
+            "description": resource.get("description") or "",
+            "tags": classification.get("domain_tags") or "",
+            "publicationDate": DateNormalizer.parse(resource["publication_date"]).timestamp(),
+            "category": classification.get("domain_category") or ""
+        }
+        if resource.get("attribution"):
+            socrata_record["attribution"] = resource["attribution"]
+
+        # Custom fields are listed as "Fieldset_Field" keys
+        custom_fields = {}
+        for field in classification.get("domain_metadata", []):
+            if "_" in field.get("key", ""):
+                fieldset, name = field["key"].split("_", 1)
+                custom_fields.setdefault(fieldset, {})[name] = field.get("value")
+        if custom_fields:
+            socrata_record["metadata"] = {"custom_fields": custom_fields}
+
+        # The catalog only has the licence name, so its terms link is looked up once per licence
+        license_name = catalog_record.get("metadata", {}).get("license")
+        if license_name:
+            if license_name not in self.licenses:
+                self.licenses[license_name] = self.socratarepo.get_metadata(resource["id"]).get("license")
+            if self.licenses[license_name]:
+                socrata_record["license"] = self.licenses[license_name]
+        return socrata_record
+
+    def _bulk_crawl(self):
+        """ Write full records from catalog pages, rather than headers to be fetched one by one with get_metadata """
+        first_page = self._catalog_page(0)
+        # The catalog may return fewer rows per page than asked for
+        page_size = len(first_page["results"]) or self.search_rows
+        pages = itertools.chain([first_page], self._fetch_pages(self._catalog_page,
+                                                                range(page_size, int(first_page["resultSetSize"]),
+                                                                      page_size)))
+        self.logger.info("Found {} items in feed".format(first_page["resultSetSize"]))
+
+        item_count = 0
+        batch = []
+        for page in pages:
+            for catalog_record in page["results"]:
+                local_identifier = catalog_record["resource"]["id"]
+                try:
+                    oai_record = self.format_socrata_to_oai(self.catalog_to_metadata(catalog_record), local_identifier)
+                except Exception as e:
+                    self.logger.error("Unable to map record {}, leaving it to be updated later: {}".format(local_identifier, e))
+                    oai_record = None
+                if oai_record:
+                    batch.append(oai_record)
+                else:
+                    self.db.write_header(local_identifier, self.repository_id)
+                if len(batch) >= int(self.write_batch_size):
+                    self.db.write_records(batch, self)
+                    batch = []
+                item_count = item_count + 1
+                if (item_count % self.update_log_after_numitems == 0):
+                    tdelta = time.time() - self.tstart + 0.1
+                    self.logger.info("Done {} items after {} ({:.1f} items/sec)".format(item_count,
+                                                                                        self.formatter.humanize(tdelta),
+                                                                                        item_count / tdelta))
+
+        self.db.write_records(batch, self)
+        self.logger.info("Processed {} items in feed, looking up {} licences".format(item_count, len(self.licenses)))
+
     def format_socrata_to_oai(self, socrata_record, local_identifier):
         record = {}
 
@@ -115,7 +204,6 @@ class SocrataRepository(HarvestRepository):
         return record
 
 
-    @rate_limited(5)
     def _update_record(self,record):
 
         try:            
@@ -134,8 +222,7 @@ class SocrataRepository(HarvestRepository):
                     pass
             # Touch the record so we do not keep requesting it on every run
             self.db.touch_record(record)
-            self.error_count = self.error_count + 1
-            if self.error_count < self.abort_after_numerrors:
+            if self._count_error():
                 return True
 
         return False
@@ -0,0 +1,8 @@
+CREATE TABLE repository_settings (
+	repository_setting_id INTEGER PRIMARY KEY NOT NULL,
+	repository_id INTEGER NOT NULL,
+	setting_name TEXT NOT NULL,
+	setting_value TEXT);
+CREATE UNIQUE INDEX repository_settings_by_repo on repository_settings(repository_id, setting_name);
+CREATE SEQUENCE IF NOT EXISTS repository_setting_id_sequence;
+ALTER TABLE repository_settings ALTER repository_setting_id SET DEFAULT NEXTVAL('repository_setting_id_sequence');
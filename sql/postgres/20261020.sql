@@ -0,0 +1,10 @@
+CREATE TABLE http_validators (
+	http_validator_id INTEGER PRIMARY KEY NOT NULL,
+	record_id INTEGER NOT NULL,
+	url TEXT NOT NULL,
+	etag TEXT,
+	last_modified TEXT);
+CREATE UNIQUE INDEX http_validators_by_url on http_validators(url);
+CREATE INDEX http_validators_by_record on http_validators(record_id);
+CREATE SEQUENCE IF NOT EXISTS http_validator_id_sequence;
+ALTER TABLE http_validators ALTER http_validator_id SET DEFAULT NEXTVAL('http_validator_id_sequence');
@@ -0,0 +1 @@
+alter table records add column source_modified_timestamp INTEGER DEFAULT 0;
@@ -0,0 +1,7 @@
+CREATE TABLE dataverse_names (
+	dataverse_name_id INTEGER PRIMARY KEY NOT NULL,
+	repository_id INTEGER NOT NULL,
+	dataverse_id TEXT NOT NULL,
+	dataverse_name TEXT,
+	updated_timestamp INTEGER NOT NULL DEFAULT 0);
+CREATE UNIQUE INDEX dataverse_names_by_repo on dataverse_names(repository_id, dataverse_id);
@@ -0,0 +1,104 @@
+-- Lookup values must be unique now that several harvest workers can insert them at once.
+-- Merge any duplicates into the oldest row first, pointing their links at it.
+
+CREATE TEMP TABLE lookup_duplicates AS
+	SELECT t.creator_id AS duplicate_id, k.keep_id
+	FROM creators t
+	JOIN (SELECT creator, MIN(creator_id) AS keep_id FROM creators GROUP BY creator HAVING COUNT(*) > 1) k
+	ON t.creator = k.creator AND t.creator_id != k.keep_id;
+UPDATE records_x_creators SET creator_id = (SELECT keep_id FROM lookup_duplicates WHERE duplicate_id = records_x_creators.creator_id)
+	WHERE creator_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DELETE FROM records_x_creators WHERE creator_id IN (SELECT keep_id FROM lookup_duplicates)
+	AND records_x_creators_id NOT IN (SELECT MIN(records_x_creators_id) FROM records_x_creators WHERE creator_id IN (SELECT keep_id FROM lookup_duplicates) GROUP BY record_id, creator_id, is_contributor);
+DELETE FROM creators WHERE creator_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DROP TABLE lookup_duplicates;
+CREATE UNIQUE INDEX creators_unique on creators(creator);
+
+CREATE TEMP TABLE lookup_duplicates AS
+	SELECT t.subject_id AS duplicate_id, k.keep_id
+	FROM subjects t
+	JOIN (SELECT subject, language, MIN(subject_id) AS keep_id FROM subjects GROUP BY subject, language HAVING COUNT(*) > 1) k
+	ON t.subject = k.subject AND t.language = k.language AND t.subject_id != k.keep_id;
+UPDATE records_x_subjects SET subject_id = (SELECT keep_id FROM lookup_duplicates WHERE duplicate_id = records_x_subjects.subject_id)
+	WHERE subject_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DELETE FROM records_x_subjects WHERE subject_id IN (SELECT keep_id FROM lookup_duplicates)
+	AND records_x_subjects_id NOT IN (SELECT MIN(records_x_subjects_id) FROM records_x_subjects WHERE subject_id IN (SELECT keep_id FROM lookup_duplicates) GROUP BY record_id, subject_id);
+DELETE FROM subjects WHERE subject_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DROP TABLE lookup_duplicates;
+CREATE UNIQUE INDEX subjects_unique on subjects(subject, language);
+
+CREATE TEMP TABLE lookup_duplicates AS
+	SELECT t.tag_id AS duplicate_id, k.keep_id
+	FROM tags t
+	JOIN (SELECT tag, language, MIN(tag_id) AS keep_id FROM tags GROUP BY tag, language HAVING COUNT(*) > 1) k
+	ON t.tag = k.tag AND t.language = k.language AND t.tag_id != k.keep_id;
+UPDATE records_x_tags SET tag_id = (SELECT keep_id FROM lookup_duplicates WHERE duplicate_id = records_x_tags.tag_id)
+	WHERE tag_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DELETE FROM records_x_tags WHERE tag_id IN (SELECT keep_id FROM lookup_duplicates)
+	AND records_x_tags_id NOT IN (SELECT MIN(records_x_tags_id) FROM records_x_tags WHERE tag_id IN (SELECT keep_id FROM lookup_duplicates) GROUP BY record_id, tag_id);
+DELETE FROM tags WHERE tag_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DROP TABLE lookup_duplicates;
+CREATE UNIQUE INDEX tags_unique on tags(tag, language);
+
+CREATE TEMP TABLE lookup_duplicates AS
+	SELECT t.publisher_id AS duplicate_id, k.keep_id
+	FROM publishers t
+	JOIN (SELECT publisher, MIN(publisher_id) AS keep_id FROM publishers GROUP BY publisher HAVING COUNT(*) > 1) k
+	ON t.publisher = k.publisher AND t.publisher_id != k.keep_id;
+UPDATE records_x_publishers SET publisher_id = (SELECT keep_id FROM lookup_duplicates WHERE duplicate_id = records_x_publishers.publisher_id)
+	WHERE publisher_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DELETE FROM records_x_publishers WHERE publisher_id IN (SELECT keep_id FROM lookup_duplicates)
+	AND records_x_publishers_id NOT IN (SELECT MIN(records_x_publishers_id) FROM records_x_publishers WHERE publisher_id IN (SELECT keep_id FROM lookup_duplicates) GROUP BY record_id, publisher_id);
+DELETE FROM publishers WHERE publisher_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DROP TABLE lookup_duplicates;
+CREATE UNIQUE INDEX publishers_unique on publishers(publisher);
+
+CREATE TEMP TABLE lookup_duplicates AS
+	SELECT t.affiliation_id AS duplicate_id, k.keep_id
+	FROM affiliations t
+	JOIN (SELECT affiliation, MIN(affiliation_id) AS keep_id FROM affiliations GROUP BY affiliation HAVING COUNT(*) > 1) k
+	ON t.affiliation = k.affiliation AND t.affiliation_id != k.keep_id;
+UPDATE records_x_affiliations SET affiliation_id = (SELECT keep_id FROM lookup_duplicates WHERE duplicate_id = records_x_affiliations.affiliation_id)
+	WHERE affiliation_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DELETE FROM records_x_affiliations WHERE affiliation_id IN (SELECT keep_id FROM lookup_duplicates)
+	AND records_x_affiliations_id NOT IN (SELECT MIN(records_x_affiliations_id) FROM records_x_affiliations WHERE affiliation_id IN (SELECT keep_id FROM lookup_duplicates) GROUP BY record_id, affiliation_id);
+DELETE FROM affiliations WHERE affiliation_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DROP TABLE lookup_duplicates;
+CREATE UNIQUE INDEX affiliations_unique on affiliations(affiliation);
+
+CREATE TEMP TABLE lookup_duplicates AS
+	SELECT t.rights_id AS duplicate_id, k.keep_id
+	FROM rights t
+	JOIN (SELECT rights_hash, MIN(rights_id) AS keep_id FROM rights GROUP BY rights_hash HAVING COUNT(*) > 1) k
+	ON t.rights_hash = k.rights_hash AND t.rights_id != k.keep_id;
+UPDATE records_x_rights SET rights_id = (SELECT keep_id FROM lookup_duplicates WHERE duplicate_id = records_x_rights.rights_id)
+	WHERE rights_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DELETE FROM records_x_rights WHERE rights_id IN (SELECT keep_id FROM lookup_duplicates)
+	AND records_x_rights_id NOT IN (SELECT MIN(records_x_rights_id) FROM records_x_rights WHERE rights_id IN (SELECT keep_id FROM lookup_duplicates) GROUP BY record_id, rights_id);
+DELETE FROM rights WHERE rights_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DROP TABLE lookup_duplicates;
+CREATE UNIQUE INDEX rights_unique on rights(rights_hash);
+
+CREATE TEMP TABLE lookup_duplicates AS
+	SELECT t.access_id AS duplicate_id, k.keep_id
+	FROM access t
+	JOIN (SELECT access, MIN(access_id) AS keep_id FROM access GROUP BY access HAVING COUNT(*) > 1) k
+	ON t.access = k.access AND t.access_id != k.keep_id;
+UPDATE records_x_access SET access_id = (SELECT keep_id FROM lookup_duplicates WHERE duplicate_id = records_x_access.access_id)
+	WHERE access_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DELETE FROM records_x_access WHERE access_id IN (SELECT keep_id FROM lookup_duplicates)
+	AND records_x_access_id NOT IN (SELECT MIN(records_x_access_id) FROM records_x_access WHERE access_id IN (SELECT keep_id FROM lookup_duplicates) GROUP BY record_id, access_id);
+DELETE FROM access WHERE access_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DROP TABLE lookup_duplicates;
+CREATE UNIQUE INDEX access_unique on access(access);
+
+CREATE TEMP TABLE lookup_duplicates AS
+	SELECT t.schema_id AS duplicate_id, k.keep_id
+	FROM domain_schemas t
+	JOIN (SELECT namespace, MIN(schema_id) AS keep_id FROM domain_schemas GROUP BY namespace HAVING COUNT(*) > 1) k
+	ON t.namespace = k.namespace AND t.schema_id != k.keep_id;
+UPDATE domain_metadata SET schema_id = (SELECT keep_id FROM lookup_duplicates WHERE duplicate_id = domain_metadata.schema_id)
+	WHERE schema_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DELETE FROM domain_schemas WHERE schema_id IN (SELECT duplicate_id FROM lookup_duplicates);
+DROP TABLE lookup_duplicates;
+CREATE UNIQUE INDEX domain_schemas_unique on domain_schemas(namespace);
@@ -0,0 +1,82 @@
+import re
+import unittest
+from collections import defaultdict
+
+from lxml import etree
+
+from harvester.OAIRepository import FRDRRecord
+
+OAI_RECORD = ('<record xmlns="http://www.openarchives.org/OAI/2.0/"><header><identifier>oai:test:1</identifier>'
+              '<datestamp>2020-01-01</datestamp></header><metadata>{}</metadata></record>')
+
+METADATA = {
+    "oai_dc": '<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" '
+              'xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Title</dc:title><dc:creator>A</dc:creator>'
+              '<dc:creator>B</dc:creator><dc:identifier>http://example.org/1</dc:identifier>'
+              '<dc:date>2020-01-02</dc:date></oai_dc:dc>',
+    "ddi": '<codeBook xmlns="ddi:codebook:2_5"><stdyDscr><citation><titlStmt><titl>Title</titl><IDNo>10.1/x</IDNo>'
+           '</titlStmt><rspStmt><AuthEnty>A</AuthEnty></rspStmt><prodStmt><prodDate>2019</prodDate></prodStmt>'
+           '</citation><stdyInfo><subject><keyword>k1</keyword><keyword>k2</keyword></subject>'
+           '<abstract>About</abstract></stdyInfo></stdyDscr></codeBook>',
+    "fgdc": '<metadata><idinfo><citation><citeinfo><origin>O</origin><pubdate>2001</pubdate><title>T</title>'
+            '<onlink>http://example.org/1</onlink></citeinfo></citation><spdom><bounding><westbc>-1</westbc>'
+            '<eastbc>1</eastbc><northbc>2</northbc><southbc>-2</southbc></bounding></spdom><keywords><theme>'
+            '<themekey>a</themekey><themekey>b</themekey></theme></keywords></idinfo><!-- comment --></metadata>',
+    "frdr": '<datacite:resource xmlns:datacite="http://datacite.org/schema/kernel-4" '
+            'xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Title</dc:title><datacite:creators>'
+            '<datacite:creatorAffiliation>U</datacite:creatorAffiliation></datacite:creators><datacite:geoLocations>'
+            '<datacite:geolocationPoint>1 2</datacite:geolocationPoint></datacite:geoLocations>'
+            '<frdr:extra xmlns:frdr="http://example.org/frdr">x</frdr:extra></datacite:resource>',
+}
+
+
+def regex_xml_to_dict(tree):
+    """ The mapping FRDRRecord.xml_to_dict did with regular expressions, to compare against """
+    namespaces_to_strip = ['http://purl.org/dc/elements/1.1/', 'https://schema.datacite.org/meta/kernel-3/',
+                           'http://www.openarchives.org/OAI/2.0/']
+    fields = defaultdict(list)
+    for element in tree.findall('.//', {}):
+        tag_namespace = re.search(r'\{(.*)\}', element.tag).group(1)
+        if tag_namespace in namespaces_to_strip:
+            tag = re.sub(r'\{.*\}', '', element.tag)
+        else:
+            tag = tag_namespace + "#" + re.sub(r'\{.*\}', '', element.tag)
+        fields[tag].append(element.text)
+    return dict(fields)
+
+
+class TestFRDRRecord(unittest.TestCase):
+
+    def map(self, prefix):
+        element = etree.fromstring(OAI_RECORD.format(METADATA[prefix]))
+        record = FRDRRecord(element, paths=FRDRRecord.prefix_paths.get(prefix))
+        expected = regex_xml_to_dict(element.find('.//{http://www.openarchives.org/OAI/2.0/}metadata')[0])
+        return record.metadata, expected
+
+    def test_prefixes_map_as_before(self):
+        for prefix in METADATA:
+            with self.subTest(prefix=prefix):
+                metadata, expected = self.map(prefix)
+                self.assertEqual(metadata, expected)
+
+    def test_namespaced_keys(self):
+        metadata = self.map("frdr")[0]
+        self.assertEqual(metadata["title"], ["Title"])
+        self.assertEqual(metadata["http://datacite.org/schema/kernel-4#geolocationPoint"], ["1 2"])
+        self.assertEqual(metadata["http://example.org/frdr#extra"], ["x"])
+
+    def test_unnamespaced_elements_use_local_name(self):
+        element = etree.fromstring('<record xmlns="http://www.openarchives.org/OAI/2.0/"><header>'
+                                   '<identifier>oai:test:1</identifier><datestamp>2020-01-01</datestamp></header>'
+                                   '<metadata><fgdc xmlns=""><origin>O</origin><pubdate>2001</pubdate></fgdc>'
+                                   '</metadata></record>')
+        self.assertEqual(FRDRRecord(element).metadata, {"origin": ["O"], "pubdate": ["2001"]})
+
+    def test_metadata_xpath(self):
+        element = etree.fromstring(OAI_RECORD.format(METADATA["oai_dc"]))
+        paths = [etree.XPath("dc:title|dc:date", namespaces=FRDRRecord.xpath_namespaces)]
+        self.assertEqual(FRDRRecord(element, paths=paths).metadata, {"title": ["Title"], "date": ["2020-01-02"]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+OAI_NS = ('xmlns="http://www.openarchives.org/OAI/2.0/" xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" '
+          'xmlns:dc="http://purl.org/dc/elements/1.1/"')
+RECORD = ('<record><header><identifier>oai:test:{0}</identifier><datestamp>2026-10-01T00:00:00Z</datestamp></header>'
+          '<metadata><oai_dc:dc><dc:title>Title {0}</dc:title><dc:creator>Creator {0}</dc:creator>'
+          '<dc:identifier>http://example.org/{0}</dc:identifier><dc:date>2020-01-01</dc:date></oai_dc:dc></metadata>'
+          '</record>')
+
+
+class OAIHandler(BaseHTTPRequestHandler):
+    """ ListRecords endpoint with 25 records in pages of 10, answering the next resumption token with expired_token """
+
+    expired_token = None
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        OAIHandler.requests.append(query)
+        if query.get("verb") == "Identify":
+            self.respond('<Identify><granularity>YYYY-MM-DDThh:mm:ssZ</granularity></Identify>')
+            return
+        start = 0
+        if "resumptionToken" in query:
+            expired_token, OAIHandler.expired_token = OAIHandler.expired_token, None
+            if expired_token == 500:
+                self.send_response(500)
+                self.end_headers()
+                return
+            if expired_token is not None:
+                self.respond('<error code="{}">expired</error>'.format(expired_token))
+                return
+            start = int(query["resumptionToken"])
+        token = str(start + 10) if start + 10 < 25 else ""
+        self.respond('<ListRecords>{}<resumptionToken completeListSize="25">{}</resumptionToken></ListRecords>'.format(
+            "".join(RECORD.format(i) for i in range(start, min(start + 10, 25))), token))
+
+    def respond(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.end_headers()
+        self.wfile.write('<?xml version="1.0"?><OAI-PMH {}><responseDate>2026-10-18T10:00:00Z</responseDate>'
+                         '<request>x</request>{}</OAI-PMH>'.format(OAI_NS, body).encode())
+
+
+class TestOAIResume(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(("127.0.0.1", 0), OAIHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        # DBInterface reads its migrations from sql/ relative to the working directory
+        self.cwd = os.getcwd()
+        os.chdir(REPO_ROOT)
+        from harvester.DBInterface import DBInterface
+        self.tmpdir = tempfile.mkdtemp()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.db = DBInterface({"type": "sqlite", "dbname": os.path.join(self.tmpdir, "test.db")})
+        self.logger = logging.getLogger("test_oai_resume")
+        self.db.setLogger(self.logger)
+        OAIHandler.expired_token = None
+        OAIHandler.requests = []
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def crawl(self):
+        from harvester.OAIRepository import OAIRepository
+        repo = OAIRepository({})
+        repo.setLogger(self.logger)
+        repo.setRepoParams({"url": "http://127.0.0.1:{}/oai".format(self.server.server_port), "name": "Test",
+                            "homepage_url": "http://example.org", "type": "oai", "enabled": True,
+                            "repo_refresh_days": 7})
+        repo.setDatabase(self.db)
+        repo.crawl()
+        return repo
+
+    def assert_resume_falls_back(self, expired_token):
+        repo = self.crawl()
+        self.db.set_repo_setting(repo.repository_id, "crawl_checkpoint", json.dumps({
+            "token": "10", "pages": 1, "items": 10, "from": None, "response_date": "2026-10-18T10:00:00Z",
+            "scope": repo._harvest_scope()}))
+        OAIHandler.expired_token = expired_token
+        OAIHandler.requests = []
+
+        self.crawl()
+
+        self.assertEqual(OAIHandler.requests[0].get("resumptionToken"), "10")
+        # The harvest starts again from the first page
+        self.assertIn({"verb": "ListRecords", "metadataPrefix": "oai_dc", "from": "2026-10-18T10:00:00Z"},
+                      OAIHandler.requests[1:])
+        self.assertIsNone(self.db.get_repo_setting(repo.repository_id, "crawl_checkpoint"))
+        count = self.db.getConnection().execute("SELECT count(*) FROM records WHERE deleted = 0").fetchone()[0]
+        self.assertEqual(count, 25)
+
+    def test_resume_keeps_metadata_prefix(self):
+        from harvester.OAIRepository import FRDRRecord
+        repo = self.crawl()
+        OAIHandler.requests = []
+        records = repo.sickle.ListRecords(resumptionToken="10", metadata_prefix="oai_dc")
+        # The prefix picks the metadata paths but is not sent alongside the token
+        self.assertEqual(OAIHandler.requests, [{"verb": "ListRecords", "resumptionToken": "10"}])
+        self.assertIs(records.paths, FRDRRecord.prefix_paths["oai_dc"])
+        self.assertEqual(records.next().metadata["title"], ["Title 10"])
+
+    def test_bad_resumption_token(self):
+        self.assert_resume_falls_back("badResumptionToken")
+
+    def test_bad_argument(self):
+        self.assert_resume_falls_back("badArgument")
+
+    def test_http_error(self):
+        self.assert_resume_falls_back(500)
+
+
+if __name__ == '__main__':
+    unittest.main()